@@ -0,0 +1,30 @@
+#!/bin/bash
+
+set -o xtrace
+
+cd "$(dirname "$0")"
+
+docker network create playground-bench
+
+docker run -d --rm \
+    --name playground-bench-db \
+    --network playground-bench \
+    -e POSTGRES_PASSWORD=bench \
+    postgres:14
+
+until docker exec playground-bench-db pg_isready -U postgres; do sleep 1; done
+
+docker run --rm \
+    -e PG_DB_HOST=playground-bench-db \
+    -e PG_DB_PORT=5432 \
+    -e PG_DB_NAME=postgres \
+    -e PG_DB_USER=postgres \
+    -e PG_DB_PASSWORD=bench \
+    --network playground-bench \
+    --name benchmark \
+    -v $PWD:/home/ \
+    benkl/playground \
+    /bin/bash -c "export PYTHONPATH=/home/ && python ./benchmark/run_benchmark.py $*"
+
+docker stop playground-bench-db
+docker network rm playground-bench
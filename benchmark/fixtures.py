@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import random
+from datetime import datetime
+
+# Global constants
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+REDDIT_FIXTURE_DIR = os.path.join(FIXTURE_DIR, 'reddit')
+SITE_FIXTURE_DIR = os.path.join(FIXTURE_DIR, 'sites')
+BASE36_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def to_base36(number):
+    digits = ''
+    while True:
+        number, remainder = divmod(number, 36)
+        digits = BASE36_ALPHABET[remainder] + digits
+        if number == 0:
+            return digits
+
+
+def synthetic_post(subreddit, post_number, created_utc, rng):
+    ups = rng.randint(0, 5000)
+    return {'kind': 't3',
+            'data': {'subreddit': subreddit,
+                     'name': 't3_' + to_base36(10 ** 9 + post_number),
+                     'ups': ups,
+                     'created_utc': float(created_utc),
+                     'upvote_ratio': round(rng.uniform(0.5, 1.0), 2),
+                     'num_comments': rng.randint(0, ups // 4 + 1),
+                     'total_awards_received': rng.randint(0, 3),
+                     'title': f'Synthetic post {post_number} in r/{subreddit}'}}
+
+
+def synthetic_listing(subreddit, post_count, seed=0):
+    rng = random.Random(f'{subreddit}-{seed}')
+    now = int(datetime.now().timestamp())
+    offset = rng.randint(0, 10 ** 6) * 1000
+    return [synthetic_post(subreddit, offset + post_count - i, now - i * 60, rng)
+            for i in range(post_count)]
+
+
+def synthetic_front_page(site_with_parse_logic, titles_per_rule=40):
+    elements = []
+    for rule_index, (tag_name, attrs) in enumerate(site_with_parse_logic['rules']):
+        tag_name = 'div' if tag_name == 0 else tag_name
+        attrs_html = '' if attrs == 0 else ''.join(f' {attr}="{value}"' for attr, value in attrs.items())
+        for title_number in range(titles_per_rule):
+            title = f"{site_with_parse_logic['name']} headline {rule_index}-{title_number} &amp; more"
+            elements.append(f'<li><{tag_name}{attrs_html}>{title}</{tag_name}><p>Teaser text</p></li>')
+    filler = '<div class="filler"><span>Navigation</span><a href="#">Link</a></div>' * 500
+    return ('<!DOCTYPE html><html><head><title>Front page</title>'
+            '<script>var config = {"h2": "<h2>not a title</h2>"};</script></head>'
+            f'<body>{filler}<ul>{"".join(elements)}</ul>{filler}</body></html>').encode()
+
+
+def load_reddit_listings(subreddits, post_count):
+    # Recorded listings win; subreddits without a recording get a synthetic one
+    listings = {}
+    for subreddit in subreddits:
+        fixture_path = os.path.join(REDDIT_FIXTURE_DIR, subreddit + '.json')
+        if os.path.exists(fixture_path):
+            with open(fixture_path, 'r') as file:
+                listings[subreddit] = json.load(file)
+        else:
+            listings[subreddit] = synthetic_listing(subreddit, post_count)
+    return listings
+
+
+def load_front_pages(site_list_with_parse_logic):
+    front_pages = {}
+    for site_with_parse_logic in site_list_with_parse_logic:
+        fixture_path = os.path.join(SITE_FIXTURE_DIR, site_with_parse_logic['name'] + '.html')
+        if os.path.exists(fixture_path):
+            with open(fixture_path, 'rb') as file:
+                front_pages[site_with_parse_logic['name']] = file.read()
+        else:
+            front_pages[site_with_parse_logic['name']] = synthetic_front_page(site_with_parse_logic)
+    return front_pages
+
+
+def record_fixtures(subreddits, site_list_with_parse_logic, post_count):
+    # Captures live responses once, so benchmark runs can replay them offline
+    from reddit_posts_extract_modules.reddit_api_interface import api_auth, iter_posts
+    from news_sites_extract_modules.title_list_scraper import fetch_page
+
+    os.makedirs(REDDIT_FIXTURE_DIR, exist_ok=True)
+    os.makedirs(SITE_FIXTURE_DIR, exist_ok=True)
+
+    TOKEN = api_auth()
+    for subreddit in subreddits:
+        post_list = list(iter_posts(subreddit, TOKEN, min_posts=post_count, max_posts=post_count))
+        with open(os.path.join(REDDIT_FIXTURE_DIR, subreddit + '.json'), 'w') as file:
+            json.dump(post_list, file)
+
+    for site_with_parse_logic in site_list_with_parse_logic:
+        page_content, _ = fetch_page(site_with_parse_logic['link'])
+        with open(os.path.join(SITE_FIXTURE_DIR, site_with_parse_logic['name'] + '.html'), 'wb') as file:
+            file.write(page_content)
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'extract'))
+    from extract_reddit_posts import SUBREDDITS, MAX_POSTS_TO_FETCH
+    from extract_news_titles import SITE_LIST_PARSE_LOGIC_FILE
+    from news_sites_extract_modules.title_list_scraper import load_site_list
+
+    record_fixtures(subreddits=sorted(set(SUBREDDITS.split(','))),
+                    site_list_with_parse_logic=load_site_list(SITE_LIST_PARSE_LOGIC_FILE),
+                    post_count=MAX_POSTS_TO_FETCH)
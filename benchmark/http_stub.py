@@ -0,0 +1,77 @@
+import json
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # Serves Reddit's token and /new listing endpoints plus news front pages from fixtures
+    listings = {}
+    front_pages = {}
+    latency_seconds = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type, extra_headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (extra_headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _delay(self):
+        if self.latency_seconds:
+            threading.Event().wait(self.latency_seconds)
+
+    def do_POST(self):
+        self._delay()
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/api/v1/access_token'):
+            body = json.dumps({'access_token': 'benchmark-token', 'expires_in': 86400}).encode()
+            return self._send(200, body, 'application/json')
+        self._send(404, b'', 'text/plain')
+
+    def do_GET(self):
+        self._delay()
+        url = urlparse(self.path)
+        path_parts = url.path.strip('/').split('/')
+
+        if len(path_parts) == 3 and path_parts[0] == 'r' and path_parts[2] == 'new':
+            posts = self.listings.get(path_parts[1])
+            if posts is None:
+                return self._send(404, b'', 'text/plain')
+            query = parse_qs(url.query)
+            limit = int(query.get('limit', ['25'])[0])
+            after = query.get('after', [None])[0]
+            start = 0
+            if after is not None:
+                names = [post['data']['name'] for post in posts]
+                start = names.index(after) + 1 if after in names else len(posts)
+            page = posts[start:start + limit]
+            next_after = page[-1]['data']['name'] if page and start + limit < len(posts) else None
+            body = json.dumps({'data': {'children': page, 'after': next_after}}).encode()
+            return self._send(200, body, 'application/json',
+                              {'X-Ratelimit-Remaining': '600', 'X-Ratelimit-Reset': '600'})
+
+        if len(path_parts) == 2 and path_parts[0] == 'sites' and path_parts[1] in self.front_pages:
+            body = self.front_pages[path_parts[1]]
+            etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+            if self.headers.get('If-None-Match') == etag:
+                return self._send(304, b'', 'text/html', {'ETag': etag})
+            return self._send(200, body, 'text/html; charset=utf-8', {'ETag': etag})
+
+        self._send(404, b'', 'text/plain')
+
+
+def start_stub(listings, front_pages, latency_seconds=0.0):
+    handler = type('StubHandler', (_StubHandler,), {'listings': listings,
+                                                    'front_pages': front_pages,
+                                                    'latency_seconds': latency_seconds})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
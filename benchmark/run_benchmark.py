@@ -0,0 +1,477 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'extract'))
+
+from benchmark.fixtures import load_reddit_listings, load_front_pages, synthetic_post
+from benchmark.http_stub import start_stub
+from common.db_operations import (execute_sql, insert_rows, create_partition, transaction, close_pool,
+                                  INSERT_METHODS, create_watermark_table, record_watermarks,
+                                  get_missing_date_hours, get_unprocessed_date_hours, date_hours_values_sql,
+                                  invalidate_watermarks)
+from common.schema_management import maintain_table, table_exists, TABLE_INDEXES
+from common.compact_storage import compact_table_name, legacy_table_name, drop_legacy_table
+from common import spool
+import extract_reddit_posts
+import extract_news_titles
+from reddit_posts_extract_modules import reddit_api_interface
+from news_sites_extract_modules import title_list_scraper
+from transform import fct_reddit_snapshots_hourly as fct
+from transform import agg_subreddit_metrics_hourly as agg
+
+
+# Global constants
+TABLE_PREFIX = 'bench_'
+BENCH_DB_HOSTS = ('localhost', '127.0.0.1', 'playground-bench-db')
+BENCH_TABLES = ('reddit_data', 'reddit_fetch_cursors', 'insert_check', 'scraped_titles', 'scraped_title_intervals',
+                'fct_reddit_snapshots_hourly', 'fct_reddit_posts_latest', 'fct_check',
+                'agg_subreddit_metrics_hourly', 'agg_subreddit_metrics_daily', 'agg_subreddit_metrics_weekly',
+                'agg_lag_check', 'agg_self_join_check', 'agg_legacy_check')
+COMPACT_TABLES = ('reddit_data', 'fct_reddit_snapshots_hourly')
+
+results = []
+
+
+@contextmanager
+def timed(stage, unit):
+    # The body stores its unit count in the yielded dict
+    measurement = {'units': 0}
+    start = time.perf_counter()
+    yield measurement
+    seconds = time.perf_counter() - start
+    results.append({'stage': stage,
+                    'seconds': round(seconds, 4),
+                    'units': measurement['units'],
+                    'unit': unit,
+                    'per_second': round(measurement['units'] / seconds, 1) if seconds else None})
+
+
+def bench_table(table_name_base):
+    return TABLE_PREFIX + table_name_base
+
+
+def reset_database():
+    create_watermark_table()
+    with transaction():
+        spool.create_spool_table()
+        for table_name_base in COMPACT_TABLES:
+            # After a compact run the original name is a view over the *_compact table
+            table_name = bench_table(table_name_base)
+            relkind = execute_sql(sql=f"select relkind::VARCHAR from pg_class where oid = to_regclass('{table_name}');")
+            if relkind and relkind[0][0] == 'v':
+                execute_sql(sql=f"DROP VIEW IF EXISTS {table_name} CASCADE;")
+            for physical_table_name in (compact_table_name(table_name), legacy_table_name(table_name)):
+                execute_sql(sql=f"DROP TABLE IF EXISTS {physical_table_name} CASCADE;")
+        for table_name_base in BENCH_TABLES:
+            execute_sql(sql=f"DROP TABLE IF EXISTS {bench_table(table_name_base)} CASCADE;")
+        execute_sql(sql=f"DELETE FROM etl_watermarks WHERE table_name LIKE '{TABLE_PREFIX}%';")
+        execute_sql(sql=f"DELETE FROM {spool.SPOOL_TABLE_NAME} WHERE stream LIKE '{TABLE_PREFIX}%';")
+
+
+def use_bench_tables(subreddits, work_dir):
+    # Same idea as pointing the API clients at the stub: the pipelines keep their production
+    # naming logic, only the names they start from are swapped for the bench_ ones
+    TABLE_INDEXES.update({bench_table(table_name_base): indexes
+                          for table_name_base, indexes in list(TABLE_INDEXES.items())})
+    extract_reddit_posts.TABLE_NAME_BASE = bench_table('reddit_data')
+    extract_reddit_posts.PARTITION_PREFIX_BASE = TABLE_PREFIX + extract_reddit_posts.PARTITION_PREFIX_BASE
+    extract_reddit_posts.CURSOR_TABLE_NAME_BASE = bench_table(extract_reddit_posts.CURSOR_TABLE_NAME_BASE)
+    extract_reddit_posts.SPOOL_STREAM_BASE = bench_table(extract_reddit_posts.SPOOL_STREAM_BASE)
+    extract_reddit_posts.DOWNSTREAM_TABLE_NAME_BASES = tuple(
+        bench_table(table_name_base) for table_name_base in extract_reddit_posts.DOWNSTREAM_TABLE_NAME_BASES)
+    extract_reddit_posts.PAIRED_DOWNSTREAM_TABLE_NAME_BASES = tuple(
+        bench_table(table_name_base) for table_name_base in extract_reddit_posts.PAIRED_DOWNSTREAM_TABLE_NAME_BASES)
+    extract_reddit_posts.SUBREDDITS = ','.join(subreddits)
+
+    extract_news_titles.TABLE_NAME_BASE = bench_table(extract_news_titles.TABLE_NAME_BASE)
+    extract_news_titles.PARTITION_PREFIX_BASE = TABLE_PREFIX + extract_news_titles.PARTITION_PREFIX_BASE
+    extract_news_titles.INTERVAL_TABLE_NAME_BASE = bench_table(extract_news_titles.INTERVAL_TABLE_NAME_BASE)
+    extract_news_titles.SPOOL_STREAM_BASE = bench_table(extract_news_titles.SPOOL_STREAM_BASE)
+    extract_news_titles.INTERVAL_SPOOL_STREAM_BASE = bench_table(extract_news_titles.INTERVAL_SPOOL_STREAM_BASE)
+    page_cache_path = os.path.join(work_dir, 'page_cache.json')
+    extract_news_titles.load_page_cache = partial(title_list_scraper.load_page_cache, page_cache_path)
+    extract_news_titles.save_page_cache = partial(title_list_scraper.save_page_cache, page_cache_path)
+    spool.SPOOL_DIR = os.path.join(work_dir, 'spool')
+
+    fct.SOURCE_TABLE_NAME_BASE = bench_table(fct.SOURCE_TABLE_NAME_BASE)
+    fct.TARGET_TABLE_NAME_BASE = bench_table(fct.TARGET_TABLE_NAME_BASE)
+    fct.TARGET_PARTITION_PREFIX_BASE = TABLE_PREFIX + fct.TARGET_PARTITION_PREFIX_BASE
+    fct.LATEST_TABLE_NAME_BASE = bench_table(fct.LATEST_TABLE_NAME_BASE)
+
+    agg.SOURCE_TABLE_NAME_BASE = bench_table(agg.SOURCE_TABLE_NAME_BASE)
+    agg.UPSTREAM_TABLE_NAME_BASE = bench_table(agg.UPSTREAM_TABLE_NAME_BASE)
+    agg.LATEST_STATE_TABLE_NAME_BASE = bench_table(agg.LATEST_STATE_TABLE_NAME_BASE)
+    agg.TARGET_TABLE_NAME_BASE = bench_table(agg.TARGET_TABLE_NAME_BASE)
+    agg.TARGET_PARTITION_PREFIX_BASE = TABLE_PREFIX + agg.TARGET_PARTITION_PREFIX_BASE
+
+
+def bench_fetch(stub_url, subreddits, post_count):
+    reddit_api_interface.REDDIT_AUTH_URL = stub_url + '/api/v1/access_token'
+    reddit_api_interface.REDDIT_API_URL = stub_url
+    reddit_api_interface.TOKEN_CACHE_PATH = os.path.join(tempfile.mkdtemp(), 'token.json')
+    for env_var in ('PG_REDDIT_GRANT_TYPE', 'PG_REDDIT_USERNAME', 'PG_REDDIT_PASSWORD',
+                    'PG_REDDIT_CLIENT_ID', 'PG_REDDIT_SECRET_TOKEN', 'PG_REDDIT_USER_AGENT'):
+        os.environ.setdefault(env_var, 'benchmark')
+
+    fetched_rows = []
+    with timed('fetch', 'posts') as measurement:
+        TOKEN = reddit_api_interface.api_auth()
+        for _, rows, _ in reddit_api_interface.fetch_posts_concurrently(
+                subreddit_list=subreddits,
+                post_count=extract_reddit_posts.POSTS_TO_FETCH,
+                TOKEN=TOKEN,
+                max_workers=extract_reddit_posts.FETCH_WORKERS,
+                max_post_count=post_count,
+                row_builder=extract_reddit_posts.filter_enrich_post_list):
+            fetched_rows += rows
+        measurement['units'] = len(fetched_rows)
+    return fetched_rows
+
+
+def bench_parse(stub_url, site_list_with_parse_logic):
+    stub_sites = [{**site, 'link': f"{stub_url}/sites/{site['name']}"} for site in site_list_with_parse_logic]
+    for stage in ('parse', 'parse (conditional GET hit)'):
+        if stage == 'parse':
+            title_list_scraper._page_cache.clear()
+        with timed(stage, 'titles') as measurement:
+            for _, title_list, _ in title_list_scraper.get_title_lists_from_sites(
+                    stub_sites, max_workers=extract_news_titles.SCRAPE_WORKERS):
+                measurement['units'] += len(title_list)
+
+
+def bench_insert(fetched_rows):
+    # Scratch table: the pipeline stages below only see the watermarked history
+    table_name = bench_table('insert_check')
+    with transaction():
+        extract_reddit_posts.create_table(table_name)
+    maintain_table(table_name, table_name + '_')
+
+    for method in INSERT_METHODS:
+        with timed(f'insert ({method})', 'rows') as measurement:
+            insert_rows(table_name,
+                        columns=extract_reddit_posts.INSERT_COLUMNS,
+                        rows=fetched_rows,
+                        method=method)
+            measurement['units'] = len(fetched_rows)
+
+
+def synthetic_history(subreddits, posts_per_snapshot, days):
+    # Every hour each subreddit's /new window slides by a tenth: new posts arrive, the oldest drop out
+    new_posts_per_hour = max(1, posts_per_snapshot // 10)
+    first_hour = datetime.combine(datetime.today().date() - timedelta(days=days - 1), datetime.min.time())
+    for day in range(days):
+        day_rows = []
+        for hour in range(24):
+            snapshot_time = first_hour + timedelta(days=day, hours=hour, minutes=8)
+            hour_number = day * 24 + hour
+            for subreddit_number, subreddit in enumerate(subreddits):
+                rng = random.Random(f'{subreddit}-{hour_number}')
+                newest_post_number = (subreddit_number * 10 ** 6
+                                      + (hour_number + 1) * new_posts_per_hour + posts_per_snapshot)
+                post_list = [synthetic_post(subreddit,
+                                            newest_post_number - i,
+                                            snapshot_time.timestamp() - i * 360,
+                                            rng)
+                             for i in range(posts_per_snapshot)]
+                day_rows += extract_reddit_posts.filter_enrich_post_list(post_list, snapshot_time)
+        yield (first_hour + timedelta(days=day)).strftime('%Y-%m-%d'), day_rows
+
+
+def bench_seed(subreddits, posts_per_snapshot, days):
+    table_name = extract_reddit_posts.TABLE_NAME_BASE
+    partition_prefix = extract_reddit_posts.PARTITION_PREFIX_BASE
+    with transaction():
+        extract_reddit_posts.create_table(table_name)
+    with timed('seed history', 'rows') as measurement:
+        for date_stamp, day_rows in synthetic_history(subreddits, posts_per_snapshot, days):
+            with transaction():
+                create_partition(table_name, partition_prefix, date_stamp)
+                insert_rows(table_name, columns=extract_reddit_posts.INSERT_COLUMNS, rows=day_rows)
+                record_watermarks(table_name, [(date_stamp, hour) for hour in range(24)])
+            measurement['units'] += len(day_rows)
+
+
+def bench_gap_detection(lookback_days):
+    source_table_name = fct.SOURCE_TABLE_NAME_BASE
+    target_table_name = fct.TARGET_TABLE_NAME_BASE
+    with transaction():
+        fct.create_table(target_table_name)
+
+    with timed('gap detection (table scan)', 'hours') as measurement:
+        missing_date_hours = get_missing_date_hours(source_table_name=source_table_name,
+                                                    source_date_field=fct.SOURCE_DATE_FIELD,
+                                                    source_hour_field=fct.SOURCE_HOUR_FIELD,
+                                                    target_table_name=target_table_name,
+                                                    target_date_field=fct.TARGET_DATE_FIELD,
+                                                    target_hour_field=fct.TARGET_HOUR_FIELD,
+                                                    lookback_days=lookback_days)
+        measurement['units'] = len(missing_date_hours)
+
+    with timed('gap detection (watermarks)', 'hours') as measurement:
+        missing_date_hours = get_unprocessed_date_hours(source_table_name=source_table_name,
+                                                        target_table_name=target_table_name,
+                                                        lookback_days=lookback_days)
+        measurement['units'] = len(missing_date_hours)
+    return missing_date_hours
+
+
+def count_rows(table_name):
+    return execute_sql(sql=f"select count(1) from {table_name};")[0][0]
+
+
+def count_watermarks(table_name):
+    return execute_sql(sql=f"select count(1) from etl_watermarks where table_name = '{table_name}';")[0][0]
+
+
+def bench_extract_pipelines(stub_url, site_list_with_parse_logic):
+    # The full extract runs: cursors, spool segments, the background flusher and the final drain
+    table_name = extract_reddit_posts.TABLE_NAME_BASE
+    rows_before = count_rows(table_name)
+    with timed('extract pipeline (reddit)', 'rows') as measurement:
+        extract_reddit_posts.pipeline(is_test=False)
+        measurement['units'] = count_rows(table_name) - rows_before
+
+    stub_sites = [{**site, 'link': f"{stub_url}/sites/{site['name']}"} for site in site_list_with_parse_logic]
+    with timed('extract pipeline (news)', 'titles') as measurement:
+        extract_news_titles.pipeline(False, stub_sites)
+        measurement['units'] = count_rows(extract_news_titles.INTERVAL_TABLE_NAME_BASE
+                                          if extract_news_titles.TITLE_STORAGE_MODE == 'intervals'
+                                          else extract_news_titles.TABLE_NAME_BASE)
+
+
+def bench_transform_pipelines():
+    # Whatever FACT_TRANSFORM_MODE and AGG_ENGINE default to, including the watermark and upstream gap gating
+    with timed(f'fct pipeline ({fct.FACT_TRANSFORM_MODE})', 'rows') as measurement:
+        fct.pipeline(is_test=False)
+        measurement['units'] = count_rows(fct.TARGET_TABLE_NAME_BASE)
+
+    with timed(f'agg pipeline ({agg.AGG_ENGINE})', 'hours') as measurement:
+        agg.pipeline(is_test=False)
+        measurement['units'] = count_watermarks(agg.TARGET_TABLE_NAME_BASE)
+
+
+def create_check_table(create_table, table_name, date_hours):
+    with transaction():
+        create_table(table_name)
+        for date_stamp in sorted(set(date_hour[0] for date_hour in date_hours)):
+            create_partition(table_name, table_name + '_', date_stamp)
+
+
+def count_mismatches(left_sql, right_sql):
+    mismatch_sql = f"""
+        select count(1) from (
+            ({left_sql} except all {right_sql})
+            union all
+            ({right_sql} except all {left_sql})
+        ) as mismatches;
+    """
+    return execute_sql(sql=mismatch_sql)[0][0]
+
+
+def select_date_hours_sql(table_name, date_hours):
+    return f"""
+        select * from {table_name}
+        where (snapshotted_on, snapshotted_hour) in (values {date_hours_values_sql(date_hours)})
+    """
+
+
+def bench_parity(check_hours):
+    # The pipelines' output on the most recent hours against the original per-hour statements
+    fct_table_name = fct.TARGET_TABLE_NAME_BASE
+    agg_table_name = agg.TARGET_TABLE_NAME_BASE
+    sample_date_hours = [tuple(date_hour) for date_hour in execute_sql(sql=f"""
+        select unit_date::VARCHAR, unit_hour
+        from etl_watermarks
+        where table_name = '{agg_table_name}'
+        order by 1 desc, 2 desc
+        limit {check_hours};
+    """)][::-1]
+
+    fct_check_table_name = bench_table('fct_check')
+    create_check_table(fct.create_table, fct_check_table_name, sample_date_hours)
+    for date_hour in sample_date_hours:
+        fct.transform_reddit_data(fct.SOURCE_TABLE_NAME_BASE, fct_check_table_name,
+                                  snapshotted_on=date_hour[0], snapshotted_hour=date_hour[1])
+
+    lag_check_table_name = bench_table('agg_lag_check')
+    self_join_check_table_name = bench_table('agg_self_join_check')
+    for check_table_name in (lag_check_table_name, self_join_check_table_name):
+        create_check_table(agg.create_table, check_table_name, sample_date_hours)
+
+    with timed('agg sample (lag engine)', 'hours') as measurement:
+        agg.aggregate_reddit_data_lag(fct_table_name, lag_check_table_name, sample_date_hours)
+        measurement['units'] = len(sample_date_hours)
+
+    with timed('agg sample (self join engine)', 'hours') as measurement:
+        for date_hour in sample_date_hours:
+            agg.aggregate_reddit_data(fct_table_name, self_join_check_table_name,
+                                      snapshotted_on=date_hour[0], snapshotted_hour=date_hour[1])
+        measurement['units'] = len(sample_date_hours)
+
+    self_join_sql = f"select * from {self_join_check_table_name}"
+    return {f'fct pipeline ({fct.FACT_TRANSFORM_MODE}) vs hourly statement':
+                count_mismatches(select_date_hours_sql(fct_table_name, sample_date_hours),
+                                 f"select * from {fct_check_table_name}"),
+            f'agg pipeline ({agg.AGG_ENGINE}) vs self join':
+                count_mismatches(select_date_hours_sql(agg_table_name, sample_date_hours), self_join_sql),
+            'agg lag engine vs self join':
+                count_mismatches(f"select * from {lag_check_table_name}", self_join_sql)}
+
+
+def relation_size(table_name):
+    # Heap, TOAST and indexes of every partition
+    size_sql = f"""
+        select coalesce(sum(pg_total_relation_size(relid)), 0)
+        from pg_partition_tree('{table_name}');
+    """
+    return int(execute_sql(sql=size_sql)[0][0])
+
+
+def bench_compact(stub_url, check_hours):
+    # Migrates the bench tables in place, so it runs after every legacy stage
+    reddit_table_name = extract_reddit_posts.TABLE_NAME_BASE
+    reddit_partition_prefix = extract_reddit_posts.PARTITION_PREFIX_BASE
+    fct_table_name = fct.TARGET_TABLE_NAME_BASE
+    agg_table_name = agg.TARGET_TABLE_NAME_BASE
+    legacy_sizes = {table_name: relation_size(table_name) for table_name in (reddit_table_name, fct_table_name)}
+
+    with timed('compact migration (reddit_data)', 'rows') as measurement:
+        extract_reddit_posts.migrate_to_compact_storage(reddit_table_name, reddit_partition_prefix)
+        extract_reddit_posts.prepare_tables(reddit_table_name, reddit_partition_prefix,
+                                            extract_reddit_posts.CURSOR_TABLE_NAME_BASE)
+        measurement['units'] = count_rows(compact_table_name(reddit_table_name))
+
+    with timed('compact migration (fct)', 'rows') as measurement:
+        fct.pipeline(is_test=False, compact=True)
+        measurement['units'] = count_rows(compact_table_name(fct_table_name))
+
+    compact_sizes = {table_name: relation_size(compact_table_name(table_name)) for table_name in legacy_sizes}
+    parity_mismatches = {f'{table_name} compatibility view vs legacy table':
+                             count_mismatches(f"select * from {table_name}",
+                                              f"select * from {legacy_table_name(table_name)}")
+                         for table_name in legacy_sizes}
+
+    # Hand the newest hours back, so fct and agg rebuild them from the compact tables
+    sample_date_hours = [tuple(date_hour) for date_hour in execute_sql(sql=f"""
+        select unit_date::VARCHAR, unit_hour
+        from etl_watermarks
+        where table_name = '{agg_table_name}'
+        order by 1 desc, 2 desc
+        limit {check_hours};
+    """)][::-1]
+    agg_legacy_check_table_name = bench_table('agg_legacy_check')
+    with transaction():
+        execute_sql(sql=f"""
+            CREATE TABLE {agg_legacy_check_table_name} AS
+            {select_date_hours_sql(agg_table_name, sample_date_hours)};
+        """)
+        invalidate_watermarks([fct_table_name, fct.LATEST_TABLE_NAME_BASE, agg_table_name], sample_date_hours)
+
+    with timed('fct pipeline (compact)', 'hours') as measurement:
+        fct.pipeline(is_test=False)
+        measurement['units'] = len(sample_date_hours)
+
+    with timed('agg pipeline (compact)', 'hours') as measurement:
+        agg.pipeline(is_test=False)
+        measurement['units'] = len(sample_date_hours)
+
+    parity_mismatches['fct pipeline (compact) vs legacy table'] = count_mismatches(
+        select_date_hours_sql(fct_table_name, sample_date_hours),
+        select_date_hours_sql(legacy_table_name(fct_table_name), sample_date_hours))
+    parity_mismatches['agg pipeline (compact) vs legacy fct'] = count_mismatches(
+        select_date_hours_sql(agg_table_name, sample_date_hours),
+        f"select * from {agg_legacy_check_table_name}")
+
+    rows_before = count_rows(reddit_table_name)
+    with timed('extract pipeline (reddit, compact)', 'rows') as measurement:
+        extract_reddit_posts.pipeline(is_test=False)
+        measurement['units'] = count_rows(reddit_table_name) - rows_before
+
+    # The explicit last migration step: drops each legacy table after its own per-partition parity check
+    with timed('drop legacy tables', 'rows') as measurement:
+        legacy_rows = sum(count_rows(legacy_table_name(table_name)) for table_name in legacy_sizes)
+        drop_legacy_table(reddit_table_name, reddit_partition_prefix, extract_reddit_posts.DATE_FIELD)
+        drop_legacy_table(fct_table_name, fct.TARGET_PARTITION_PREFIX_BASE, fct.TARGET_DATE_FIELD)
+        measurement['units'] = legacy_rows
+    parity_mismatches['legacy tables left after drop'] = sum(table_exists(legacy_table_name(table_name))
+                                                             for table_name in legacy_sizes)
+
+    return {'legacy_bytes': legacy_sizes, 'compact_bytes': compact_sizes}, parity_mismatches
+
+
+def print_report(parity_mismatches, storage_sizes=None):
+    print(f"{'stage':<36}{'seconds':>10}{'units':>12}  {'unit':<8}{'per second':>14}")
+    for result in results:
+        print(f"{result['stage']:<36}{result['seconds']:>10.3f}{result['units']:>12}  "
+              f"{result['unit']:<8}{result['per_second'] or 0:>14.1f}")
+    for check, mismatches in parity_mismatches.items():
+        print(f'mismatches, {check}: {mismatches}')
+    if storage_sizes is not None:
+        for table_name, legacy_bytes in storage_sizes['legacy_bytes'].items():
+            compact_bytes = storage_sizes['compact_bytes'][table_name]
+            print(f'storage, {table_name}: {legacy_bytes} bytes legacy, {compact_bytes} bytes compact '
+                  f'({legacy_bytes / compact_bytes if compact_bytes else 0:.2f}x smaller)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the extract and transform stages')
+    parser.add_argument('--subreddits', type=int, default=35)
+    parser.add_argument('--posts', type=int, default=100, help='posts per subreddit snapshot')
+    parser.add_argument('--days', type=int, default=3, help='days of synthetic snapshot history')
+    parser.add_argument('--latency-ms', type=float, default=50, help='simulated HTTP latency of the stub')
+    parser.add_argument('--check-hours', type=int, default=24, help='recent hours checked against the reference statements')
+    parser.add_argument('--skip-compact', action='store_true',
+                        help='skip migrating the bench tables to compact storage at the end')
+    parser.add_argument('--output', help='also write the results as JSON to this path')
+    parser.add_argument('--allow-remote-db', action='store_true',
+                        help='run even if PG_DB_HOST is not a known throwaway host')
+    args = parser.parse_args()
+
+    if os.environ.get('PG_DB_HOST') not in BENCH_DB_HOSTS and not args.allow_remote_db:
+        sys.exit(f"PG_DB_HOST must be one of {BENCH_DB_HOSTS}; the benchmark drops and rewrites "
+                 f"{TABLE_PREFIX}* tables (use --allow-remote-db to override)")
+
+    subreddits = [f'sub{number:04d}' for number in range(args.subreddits)]
+    site_list_with_parse_logic = title_list_scraper.load_site_list(extract_news_titles.SITE_LIST_PARSE_LOGIC_FILE)
+    server, stub_url = start_stub(listings=load_reddit_listings(subreddits, args.posts),
+                                  front_pages=load_front_pages(site_list_with_parse_logic),
+                                  latency_seconds=args.latency_ms / 1000)
+    try:
+        use_bench_tables(subreddits, tempfile.mkdtemp())
+        reset_database()
+        fetched_rows = bench_fetch(stub_url, subreddits, args.posts)
+        bench_parse(stub_url, site_list_with_parse_logic)
+        bench_insert(fetched_rows)
+        bench_seed(subreddits, args.posts, args.days)
+        bench_gap_detection(lookback_days=args.days + 1)
+        bench_extract_pipelines(stub_url, site_list_with_parse_logic)
+        bench_transform_pipelines()
+        parity_mismatches = bench_parity(check_hours=args.check_hours)
+        storage_sizes = None
+        if not args.skip_compact:
+            storage_sizes, compact_mismatches = bench_compact(stub_url, check_hours=args.check_hours)
+            parity_mismatches.update(compact_mismatches)
+    finally:
+        server.shutdown()
+        close_pool()
+
+    print_report(parity_mismatches, storage_sizes)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'args': vars(args), 'results': results, 'parity_mismatches': parity_mismatches,
+                       'storage_sizes': storage_sizes},
+                      file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import threading
+from datetime import datetime, timezone
+from functools import partial
+
+from common.db_operations import execute_sql, create_partition, transaction, after_commit
+from common.schema_management import table_exists, get_partition_dates
+
+# Global constants
+SUBREDDIT_DIM_TABLE_NAME = 'dim_subreddits'
+COMPACT_TABLE_SUFFIX = '_compact'
+LEGACY_TABLE_SUFFIX = '_legacy'
+IDS_VIEW_SUFFIX = '_ids'  # Compact keys with decoded labels, for joins that don't need the legacy text formats
+BASE36_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyz'
+REDDIT_POST_ID_PREFIX = 't3_'
+
+_subreddit_ids = {}
+_subreddit_ids_lock = threading.Lock()
+
+
+def compact_table_name(table_name):
+    return table_name + COMPACT_TABLE_SUFFIX
+
+
+def legacy_table_name(table_name):
+    return table_name + LEGACY_TABLE_SUFFIX
+
+
+def ids_view_name(table_name):
+    return table_name + IDS_VIEW_SUFFIX
+
+
+def compact_partition_prefix(partition_prefix):
+    # 'rd_' -> 'rdc_', 'test_rd_' -> 'test_rdc_'
+    return partition_prefix[:-1] + 'c_'
+
+
+def is_compact(table_name):
+    # After the migration the original name is a compatibility view over the compact table
+    return table_exists(compact_table_name(table_name))
+
+
+def id_keyed_source(table_name):
+    # Relation to join on post_id: the bigint-keyed view once the table is compact, the table itself otherwise
+    if is_compact(table_name):
+        return ids_view_name(table_name)
+    return table_name
+
+
+def encode_post_id(post_name):
+    # 't3_abc12' -> int('abc12', 36); every snapshot row is a post, so the t3_ kind is implied
+    if post_name is None:
+        return None
+    return int(post_name.split('_', 1)[-1], 36)
+
+
+def epoch_to_timestamp(created_utc):
+    if created_utc is None:
+        return None
+    return datetime.fromtimestamp(created_utc, timezone.utc)
+
+
+def ratio_to_permille(upvote_ratio):
+    if upvote_ratio is None:
+        return None
+    return int(round(upvote_ratio * 1000))
+
+
+def create_compact_functions():
+    # Dimension plus the SQL side of the encoding, used by the compatibility views, triggers and migration
+    create_sql = f"""
+        CREATE TABLE IF NOT EXISTS {SUBREDDIT_DIM_TABLE_NAME} (
+            subreddit_id SMALLINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            subreddit VARCHAR UNIQUE NOT NULL);
+
+        CREATE OR REPLACE FUNCTION reddit_id_to_bigint(post_name VARCHAR) RETURNS BIGINT AS $$
+        DECLARE
+            digits VARCHAR := lower(substr(post_name, strpos(post_name, '_') + 1));
+            post_id BIGINT := 0;
+        BEGIN
+            FOR i IN 1..length(digits) LOOP
+                post_id := post_id * 36 + strpos('{BASE36_ALPHABET}', substr(digits, i, 1)) - 1;
+            END LOOP;
+            RETURN post_id;
+        END
+        $$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+        CREATE OR REPLACE FUNCTION reddit_id_to_name(post_id BIGINT) RETURNS VARCHAR AS $$
+        DECLARE
+            remaining BIGINT := post_id;
+            digits VARCHAR := '';
+        BEGIN
+            LOOP
+                digits := substr('{BASE36_ALPHABET}', (remaining % 36)::INTEGER + 1, 1) || digits;
+                remaining := remaining / 36;
+                EXIT WHEN remaining = 0;
+            END LOOP;
+            RETURN '{REDDIT_POST_ID_PREFIX}' || digits;
+        END
+        $$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+        CREATE OR REPLACE FUNCTION subreddit_to_id(subreddit_name VARCHAR) RETURNS SMALLINT AS $$
+        DECLARE
+            found_id SMALLINT;
+        BEGIN
+            SELECT subreddit_id INTO found_id FROM {SUBREDDIT_DIM_TABLE_NAME} WHERE subreddit = subreddit_name;
+            IF found_id IS NULL THEN
+                INSERT INTO {SUBREDDIT_DIM_TABLE_NAME}(subreddit) VALUES (subreddit_name)
+                ON CONFLICT (subreddit) DO NOTHING;
+                SELECT subreddit_id INTO found_id FROM {SUBREDDIT_DIM_TABLE_NAME} WHERE subreddit = subreddit_name;
+            END IF;
+            RETURN found_id;
+        END
+        $$ LANGUAGE plpgsql STRICT;
+    """
+    execute_sql(sql=create_sql)
+
+
+def _remember_subreddit_ids(subreddit_ids):
+    with _subreddit_ids_lock:
+        _subreddit_ids.update(subreddit_ids)
+
+
+def get_subreddit_ids(subreddits):
+    # Only names missing from the process cache hit the database; known names never touch the identity sequence.
+    # New ids are cached once their dim rows commit, so a rolled back load can't leave ids without a dim row
+    subreddits = set(subreddit for subreddit in subreddits if subreddit is not None)
+    with _subreddit_ids_lock:
+        subreddit_ids = {subreddit: _subreddit_ids[subreddit]
+                         for subreddit in subreddits if subreddit in _subreddit_ids}
+    missing_subreddits = sorted(subreddits - set(subreddit_ids))
+    if missing_subreddits:
+        subreddit_list_sql = ', '.join(f"'{subreddit}'" for subreddit in missing_subreddits)
+        subreddit_ids_sql = f"""
+            select subreddit, subreddit_to_id(subreddit)
+            from unnest(array[{subreddit_list_sql}]::VARCHAR[]) as subreddits(subreddit);
+        """
+        new_subreddit_ids = dict(execute_sql(sql=subreddit_ids_sql))
+        subreddit_ids.update(new_subreddit_ids)
+        after_commit(partial(_remember_subreddit_ids, new_subreddit_ids))
+    return subreddit_ids
+
+
+def migrate_to_compact(table_name,
+                       partition_prefix,
+                       compact_prefix,
+                       create_compact_table,
+                       copy_partition_sql,
+                       create_compatibility_views):
+    # One-off migration in a single transaction, like convert_to_partitioned: the legacy table is kept
+    # under *_legacy and the original name becomes a view, so readers never see a missing relation
+    if is_compact(table_name) or not table_exists(table_name):
+        return
+
+    compact_name = compact_table_name(table_name)
+    with transaction():
+        create_compact_functions()
+        execute_sql(sql=f"""
+            insert into {SUBREDDIT_DIM_TABLE_NAME}(subreddit)
+            select distinct subreddit
+            from {table_name}
+            where subreddit is not null
+            order by 1
+            on conflict (subreddit) do nothing;
+        """)
+        create_compact_table(compact_name)
+        for partition_name, partition_date in sorted(get_partition_dates(table_name, partition_prefix).items()):
+            create_partition(compact_name, compact_prefix, partition_date.strftime("%Y-%m-%d"))
+            execute_sql(sql=copy_partition_sql(partition_name, compact_name))
+        execute_sql(sql=f"ALTER TABLE {table_name} RENAME TO {legacy_table_name(table_name)};")
+        create_compatibility_views(table_name, compact_name)
+
+
+def drop_legacy_table(table_name, partition_prefix, date_field):
+    # Explicit last step of the migration: the legacy copy is only dropped once each of its day partitions
+    # reads back row for row through the compatibility view (later inserts into the view don't count against it)
+    legacy_name = legacy_table_name(table_name)
+    if not is_compact(table_name) or not table_exists(legacy_name):
+        return
+
+    with transaction():
+        for partition_name, partition_date in sorted(get_partition_dates(legacy_name, partition_prefix).items()):
+            missing_rows_sql = f"""
+                select count(1) from (
+                    select * from {partition_name}
+                    except all
+                    select * from {table_name} where {date_field} = '{partition_date}'
+                ) as missing_rows;
+            """
+            missing_rows = execute_sql(sql=missing_rows_sql)[0][0]
+            if missing_rows:
+                raise RuntimeError(f"{missing_rows} rows of {partition_name} don't read back through {table_name}, "
+                                   f"keeping {legacy_name}")
+        execute_sql(sql=f"DROP TABLE {legacy_name};")
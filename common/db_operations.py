@@ -1,14 +1,42 @@
+import io
 import os
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values
+
+from common.instrumentation import stage, statement_detail, should_explain, explain_sql, record_metric
+
+# Global constants
+DB_POOL_MIN_CONNECTIONS = 1
+DB_POOL_MAX_CONNECTIONS = int(os.environ.get('PG_DB_POOL_MAX_CONNECTIONS', 10))
+DB_CONNECT_TIMEOUT_SECONDS = int(os.environ.get('PG_DB_CONNECT_TIMEOUT_SECONDS', 10))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('PG_DB_STATEMENT_TIMEOUT_MS', 15 * 60 * 1000))  # 0 disables it
+INSERT_METHODS = ('copy', 'values', 'executemany')
+VALUES_PAGE_SIZE = 1000
+WATERMARK_TABLE_NAME = 'etl_watermarks'
+
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def _connection_params():
+    return dict(host=os.environ['PG_DB_HOST'],
+                port=os.environ['PG_DB_PORT'],
+                database=os.environ['PG_DB_NAME'],
+                user=os.environ['PG_DB_USER'],
+                password=os.environ['PG_DB_PASSWORD'],
+                # A hung server fails the statement instead of blocking the caller, and with it the next capture
+                connect_timeout=DB_CONNECT_TIMEOUT_SECONDS,
+                options=f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}')
 
 
 def db_connect():
-    conn = psycopg2.connect(host=os.environ['PG_DB_HOST'],
-                            port=os.environ['PG_DB_PORT'],
-                            database=os.environ['PG_DB_NAME'],
-                            user=os.environ['PG_DB_USER'],
-                            password=os.environ['PG_DB_PASSWORD'])
+    conn = psycopg2.connect(**_connection_params())
     return conn
 
 
@@ -16,24 +44,147 @@ def db_close(conn):
     conn.close()
 
 
-def execute_sql(sql, rows=None):
-    conn = db_connect()
-    cur = conn.cursor()
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadedConnectionPool(DB_POOL_MIN_CONNECTIONS,
+                                           DB_POOL_MAX_CONNECTIONS,
+                                           **_connection_params())
+    return _pool
 
-    if rows is None:
-        cur.execute(sql)
-    else:
-        cur.executemany(sql, rows)
 
-    conn.commit()
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+@contextmanager
+def pooled_connection():
+    pool = get_pool()
+    conn = pool.getconn()
     try:
-        result = cur.fetchall()
-    except Exception:
-        result = None
-    db_close(conn)
+        yield conn
+    finally:
+        pool.putconn(conn, close=conn.closed != 0)
+
+
+@contextmanager
+def transaction():
+    # Nested scopes join the outermost transaction of the current thread
+    current_conn = getattr(_local, 'conn', None)
+    if current_conn is not None:
+        yield current_conn
+        return
+
+    with pooled_connection() as conn:
+        _local.conn = conn
+        _local.commit_callbacks = []
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            _local.conn = None
+            commit_callbacks, _local.commit_callbacks = _local.commit_callbacks, []
+    for callback in commit_callbacks:
+        callback()
+
+
+def after_commit(callback):
+    # Defers process state that mirrors uncommitted writes until the outermost transaction commits;
+    # a rollback discards it. Outside a transaction there is nothing to wait for
+    if getattr(_local, 'conn', None) is None:
+        callback()
+    else:
+        _local.commit_callbacks.append(callback)
+
+
+def _execute_explained(cur, sql):
+    # Runs the statement under EXPLAIN ANALYZE and keeps the plan with the statement's metric
+    started_at = datetime.now()
+    cur.execute(explain_sql(sql))
+    plan = cur.fetchone()[0]
+    top_plan = plan[0]['Plan']
+    record_metric('explain',
+                  started_at,
+                  plan[0].get('Execution Time', 0) / 1000,
+                  detail=statement_detail(sql),
+                  rows=top_plan.get('Actual Rows'),
+                  plan=plan)
+
+
+def execute_sql(sql, rows=None):
+    with stage('sql', detail=statement_detail(sql)) as counters:
+        with transaction() as conn:
+            with conn.cursor() as cur:
+                if rows is None and should_explain(sql):
+                    _execute_explained(cur, sql)
+                    return None
+                if rows is None:
+                    cur.execute(sql)
+                else:
+                    cur.executemany(sql, rows)
+
+                result = cur.fetchall() if cur.description is not None else None
+                counters['rows'] = len(result) if result is not None else max(cur.rowcount, 0)
     return result
 
 
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
+def copy_rows(table_name, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(map(_copy_value, row)))
+        buffer.write('\n')
+
+    copy_sql = f"COPY {table_name} ({','.join(columns)}) FROM STDIN"
+    with stage('copy', detail=table_name) as counters:
+        counters['bytes'] = buffer.tell()
+        buffer.seek(0)
+        with transaction() as conn:
+            with conn.cursor() as cur:
+                cur.copy_expert(copy_sql, buffer)
+                counters['rows'] = cur.rowcount
+
+
+def insert_rows(table_name, columns, rows, method='copy'):
+    if method not in INSERT_METHODS:
+        raise ValueError(f"Unknown insert method '{method}', expected one of {INSERT_METHODS}")
+
+    if method == 'copy':
+        copy_rows(table_name, columns, rows)
+    elif method == 'values':
+        values_sql = f"INSERT INTO {table_name} ({','.join(columns)}) VALUES %s"
+        with stage('insert_values', detail=table_name) as counters:
+            with transaction() as conn:
+                with conn.cursor() as cur:
+                    execute_values(cur, values_sql, rows, page_size=VALUES_PAGE_SIZE)
+            counters['rows'] = len(rows)
+    else:
+        insert_sql = f"""
+            INSERT INTO {table_name}
+                ({','.join(columns)})
+                VALUES ({','.join(['%s'] * len(columns))})
+        """
+        execute_sql(sql=insert_sql, rows=rows)
+
+
 def create_partition(table_name, partition_prefix, date_stamp):
     partition_name = partition_prefix + date_stamp.replace("-", "_")
     date_stamp_next_date = (
@@ -62,6 +213,7 @@ def get_missing_date_hours(source_table_name,
                 {source_hour_field} as hr
             from {source_table_name} 
             where {source_date_field} > now()::DATE - {lookback_days}
+            and {source_hour_field} is not null
         ),
 
         tgt as (
@@ -84,4 +236,163 @@ def get_missing_date_hours(source_table_name,
         order by 1,2;
     """
     missing_date_hours = execute_sql(sql=diff_sql)
-    return missing_date_hours
\ No newline at end of file
+    return missing_date_hours
+
+
+def chunk_date_hours(date_hours, chunk_size):
+    date_hours = list(date_hours)
+    for i in range(0, len(date_hours), chunk_size):
+        yield date_hours[i:i + chunk_size]
+
+
+def shard_date_hours_by_day(date_hours):
+    day_shards = {}
+    for date_hour in date_hours:
+        day_shards.setdefault(date_hour[0], []).append(date_hour)
+    return day_shards
+
+
+def _run_shard(shard_function, shard_args):
+    with transaction():
+        shard_function(*shard_args)
+
+
+def run_sharded(shard_function, shards, max_workers):
+    # Each shard commits on its own pooled connection; yields (shard args, exception or None) as shards finish.
+    # One connection stays free for the caller, the pool raises instead of blocking when exhausted
+    max_workers = max(1, min(max_workers, DB_POOL_MAX_CONNECTIONS - 1))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_run_shard, shard_function, shard_args): shard_args
+                   for shard_args in shards}
+        for future in as_completed(futures):
+            yield futures[future], future.exception()
+
+
+def date_hours_values_sql(date_hours):
+    return ',\n'.join(f"('{date_hour[0]}'::DATE, {int(date_hour[1])})"
+                       for date_hour in date_hours)
+
+
+def create_watermark_table():
+    create_sql = f"""
+        CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE_NAME} (
+            table_name VARCHAR,
+            unit_date DATE,
+            unit_hour INTEGER,
+            processed_at TIMESTAMP DEFAULT now(),
+            PRIMARY KEY (table_name, unit_date, unit_hour));
+    """
+    execute_sql(sql=create_sql)
+
+
+def record_watermarks(table_name, date_hours):
+    if not date_hours:
+        return
+    record_sql = f"""
+        insert into {WATERMARK_TABLE_NAME}(table_name, unit_date, unit_hour)
+        select '{table_name}', unit_date, unit_hour
+        from (values
+            {date_hours_values_sql(date_hours)}
+        ) as processed(unit_date, unit_hour)
+        on conflict do nothing;
+    """
+    execute_sql(sql=record_sql)
+
+
+def invalidate_watermarks(table_names, date_hours):
+    # Hands hours that received late rows back to the steps that had already processed them
+    if not table_names or not date_hours:
+        return
+    invalidate_sql = f"""
+        delete from {WATERMARK_TABLE_NAME}
+        where table_name in ({', '.join(f"'{table_name}'" for table_name in table_names)})
+        and (unit_date, unit_hour) in (values
+            {date_hours_values_sql(date_hours)}
+        );
+    """
+    execute_sql(sql=invalidate_sql)
+
+
+def following_date_hours(date_hours):
+    next_hours = [datetime.strptime(str(date_hour[0]), '%Y-%m-%d') + timedelta(hours=int(date_hour[1]) + 1)
+                  for date_hour in date_hours]
+    return sorted(set((next_hour.strftime('%Y-%m-%d'), next_hour.hour) for next_hour in next_hours))
+
+
+def delete_date_hours(table_name, date_field, hour_field, date_hours):
+    # Clears hours before they are rebuilt, so a rerun replaces rather than duplicates or conflicts
+    if not date_hours:
+        return
+    source_dates = ', '.join(sorted(set(f"'{date_hour[0]}'" for date_hour in date_hours)))
+    delete_sql = f"""
+        delete from {table_name}
+        where {date_field} in ({source_dates})
+        and ({date_field}, {hour_field}) in (values
+            {date_hours_values_sql(date_hours)}
+        );
+    """
+    execute_sql(sql=delete_sql)
+
+
+def seed_watermarks(table_name, date_field, hour_field, lookback_days):
+    seed_sql = f"""
+        insert into {WATERMARK_TABLE_NAME}(table_name, unit_date, unit_hour)
+        select distinct
+            '{table_name}',
+            {date_field},
+            {hour_field}
+        from {table_name}
+        where {date_field} > now()::DATE - {lookback_days}
+        and {hour_field} is not null
+        on conflict do nothing;
+    """
+    execute_sql(sql=seed_sql)
+
+
+def get_unprocessed_date_hours(source_table_name, target_table_name, lookback_days):
+    diff_sql = f"""
+        select
+            src.unit_date::VARCHAR,
+            src.unit_hour::INTEGER
+        from {WATERMARK_TABLE_NAME} as src
+        where src.table_name = '{source_table_name}'
+        and src.unit_date > now()::DATE - {lookback_days}
+        and not exists (
+            select 1
+            from {WATERMARK_TABLE_NAME} as tgt
+            where tgt.table_name = '{target_table_name}'
+            and tgt.unit_date = src.unit_date
+            and tgt.unit_hour = src.unit_hour)
+        order by 1,2;
+    """
+    return execute_sql(sql=diff_sql)
+
+
+def get_date_hours_to_process(source_table_name,
+                              source_date_field,
+                              source_hour_field,
+                              target_table_name,
+                              target_date_field,
+                              target_hour_field,
+                              lookback_days,
+                              full_reconcile=False):
+    create_watermark_table()
+    with stage('gap_detection', detail=target_table_name) as counters:
+        if not full_reconcile:
+            missing_date_hours = get_unprocessed_date_hours(source_table_name=source_table_name,
+                                                            target_table_name=target_table_name,
+                                                            lookback_days=lookback_days)
+        else:
+            # Repair path: diff the tables themselves and rebuild the watermarks from what is really there
+            with transaction():
+                seed_watermarks(source_table_name, source_date_field, source_hour_field, lookback_days)
+                seed_watermarks(target_table_name, target_date_field, target_hour_field, lookback_days)
+            missing_date_hours = get_missing_date_hours(source_table_name=source_table_name,
+                                                        source_date_field=source_date_field,
+                                                        source_hour_field=source_hour_field,
+                                                        target_table_name=target_table_name,
+                                                        target_date_field=target_date_field,
+                                                        target_hour_field=target_hour_field,
+                                                        lookback_days=lookback_days)
+        counters['rows'] = len(missing_date_hours)
+    return missing_date_hours
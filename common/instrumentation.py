@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import cProfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# Global constants
+METRICS_TABLE_NAME = 'etl_run_metrics'
+METRICS_LOG_PATH = os.environ.get('PG_METRICS_LOG')  # JSON lines file; unset logs to stderr
+EXPLAIN_SAMPLE_RATE = float(os.environ.get('PG_EXPLAIN_SAMPLE_RATE', 0))  # Share of write statements run under EXPLAIN ANALYZE
+PROFILE_DIR = os.environ.get('PG_PROFILE_DIR', os.path.join(os.getcwd(), 'profiles'))
+EXPLAIN_STATEMENT_TYPES = ('insert', 'update', 'delete')
+STATEMENT_DETAIL_LENGTH = 160
+METRIC_COLUMNS = ('run_id', 'pipeline', 'stage', 'detail', 'started_at',
+                  'duration_ms', 'row_count', 'byte_count', 'plan')
+
+_run = {'run_id': None, 'pipeline': None}
+_metrics = []
+_metrics_lock = threading.Lock()
+_local = threading.local()
+_metrics_logger = logging.getLogger('etl_metrics')
+
+
+def _configure_logger():
+    if _metrics_logger.handlers:
+        return
+    handler = logging.FileHandler(METRICS_LOG_PATH) if METRICS_LOG_PATH else logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _metrics_logger.addHandler(handler)
+    _metrics_logger.setLevel(logging.INFO)
+    _metrics_logger.propagate = False
+
+
+def is_recording():
+    return _run['run_id'] is not None and not getattr(_local, 'suspended', False)
+
+
+def record_metric(stage_name, started_at, duration_seconds, detail=None, rows=None, bytes_count=None, plan=None):
+    if not is_recording():
+        return
+    metric = {'run_id': _run['run_id'],
+              'pipeline': _run['pipeline'],
+              'stage': stage_name,
+              'detail': detail,
+              'started_at': started_at.isoformat(sep=' '),
+              'duration_ms': round(duration_seconds * 1000, 3),
+              'row_count': rows,
+              'byte_count': bytes_count,
+              'plan': json.dumps(plan) if plan is not None else None}
+    with _metrics_lock:
+        _metrics.append(metric)
+    _metrics_logger.info(json.dumps({key: value for key, value in metric.items()
+                                     if value is not None and key != 'plan'}))
+
+
+@contextmanager
+def stage(stage_name, detail=None):
+    # Yields a counter dict; count() adds to the innermost open stage of the calling thread
+    counters = {'rows': None, 'bytes': None}
+    stack = getattr(_local, 'stages', None)
+    if stack is None:
+        stack = _local.stages = []
+    stack.append(counters)
+    started_at = datetime.now()
+    start = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        duration_seconds = time.perf_counter() - start
+        stack.pop()
+        record_metric(stage_name, started_at, duration_seconds, detail=detail,
+                      rows=counters['rows'], bytes_count=counters['bytes'])
+
+
+def count(rows=0, bytes_count=0):
+    stack = getattr(_local, 'stages', None)
+    if not stack:
+        return
+    counters = stack[-1]
+    if rows:
+        counters['rows'] = (counters['rows'] or 0) + rows
+    if bytes_count:
+        counters['bytes'] = (counters['bytes'] or 0) + bytes_count
+
+
+def statement_detail(sql):
+    return ' '.join(sql.split())[:STATEMENT_DETAIL_LENGTH]
+
+
+def should_explain(sql):
+    # EXPLAIN ANALYZE executes the statement, so only single writes without result sets are sampled
+    if not EXPLAIN_SAMPLE_RATE or not is_recording():
+        return False
+    statement = sql.strip().rstrip(';').lower()
+    if not statement.startswith(EXPLAIN_STATEMENT_TYPES) or ';' in statement or 'returning' in statement:
+        return False
+    return random.random() < EXPLAIN_SAMPLE_RATE
+
+
+def explain_sql(sql):
+    return 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql.strip().rstrip(';')
+
+
+def start_run(pipeline_name):
+    _configure_logger()
+    _run['run_id'] = str(uuid.uuid4())
+    _run['pipeline'] = pipeline_name
+    with _metrics_lock:
+        _metrics.clear()
+    return _run['run_id']
+
+
+@contextmanager
+def _suspended():
+    _local.suspended = True
+    try:
+        yield
+    finally:
+        _local.suspended = False
+
+
+def create_metrics_table():
+    from common.db_operations import execute_sql
+    create_sql = f"""
+        CREATE TABLE IF NOT EXISTS {METRICS_TABLE_NAME} (
+            run_id UUID,
+            pipeline VARCHAR,
+            stage VARCHAR,
+            detail VARCHAR,
+            started_at TIMESTAMP,
+            duration_ms FLOAT,
+            row_count BIGINT,
+            byte_count BIGINT,
+            plan JSONB);
+        CREATE INDEX IF NOT EXISTS {METRICS_TABLE_NAME}_pipeline_started_at_idx
+            ON {METRICS_TABLE_NAME} (pipeline, started_at);
+    """
+    execute_sql(sql=create_sql)
+
+
+def write_run_metrics():
+    from common.db_operations import insert_rows, transaction
+    with _metrics_lock:
+        metrics = list(_metrics)
+        _metrics.clear()
+    if not metrics:
+        return
+    with _suspended():
+        with transaction():
+            create_metrics_table()
+            insert_rows(METRICS_TABLE_NAME,
+                        columns=METRIC_COLUMNS,
+                        rows=[tuple(metric[column] for column in METRIC_COLUMNS) for metric in metrics])
+
+
+def end_run():
+    try:
+        write_run_metrics()
+    except Exception:
+        _metrics_logger.exception('Failed to write run metrics for %s', _run['pipeline'])
+    finally:
+        _run['run_id'] = None
+        _run['pipeline'] = None
+
+
+def run_pipeline(pipeline_name, pipeline_function, *args, profile=False):
+    # Times the whole run, persists its metrics and optionally dumps a cProfile trace
+    start_run(pipeline_name)
+    profiler = cProfile.Profile() if profile else None
+    status = 'error'
+    try:
+        with stage('pipeline', detail=pipeline_name):
+            if profiler is not None:
+                profiler.enable()
+            try:
+                result = pipeline_function(*args)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            status = 'ok'
+        return result
+    finally:
+        _metrics_logger.info(json.dumps({'run_id': _run['run_id'], 'pipeline': pipeline_name, 'status': status}))
+        if profiler is not None:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profile_path = os.path.join(PROFILE_DIR,
+                                        f"{pipeline_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof")
+            profiler.dump_stats(profile_path)
+            _metrics_logger.info(json.dumps({'run_id': _run['run_id'], 'profile': profile_path}))
+        end_run()
@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+
+from common.db_operations import execute_sql, create_partition, transaction
+
+
+# Global constants
+PARTITIONS_AHEAD_DAYS = 2
+
+# Indexes per table (keyed by table name without the test_ prefix): (index name suffix, indexed columns)
+TABLE_INDEXES = {
+    'reddit_data': [
+        ('apicall_date_hour', 'apicall_date, apicall_hour'),
+    ],
+    'fct_reddit_snapshots_hourly': [
+        ('post_id_date_hour', 'post_id, snapshotted_on, snapshotted_hour'),
+        ('subreddit_date_hour', 'subreddit, snapshotted_on, snapshotted_hour'),
+    ],
+    'reddit_data_compact': [
+        ('apicall_date_hour', 'apicall_date, apicall_hour'),
+    ],
+    'fct_reddit_snapshots_hourly_compact': [
+        ('post_id_date_hour', 'post_id, snapshotted_on, snapshotted_hour'),
+        ('subreddit_id_date_hour', 'subreddit_id, snapshotted_on, snapshotted_hour'),
+    ],
+    'agg_subreddit_metrics_hourly': [
+        ('date_hour_subreddit', 'snapshotted_on, snapshotted_hour, subreddit'),
+    ],
+}
+
+
+def _table_name_base(table_name):
+    return table_name[len('test_'):] if table_name.startswith('test_') else table_name
+
+
+def create_indexes(table_name):
+    # Indexes created on a partitioned parent cascade to every current and future partition
+    for index_suffix, columns in TABLE_INDEXES.get(_table_name_base(table_name), []):
+        create_index_sql = f"""
+            CREATE INDEX IF NOT EXISTS {table_name}_{index_suffix}_idx
+            ON {table_name} ({columns});
+        """
+        execute_sql(sql=create_index_sql)
+
+
+def precreate_partitions(table_name, partition_prefix, days_ahead=PARTITIONS_AHEAD_DAYS):
+    today = datetime.today()
+    with transaction():
+        for day in range(days_ahead + 1):
+            date_stamp = (today + timedelta(days=day)).strftime("%Y-%m-%d")
+            create_partition(table_name, partition_prefix, date_stamp)
+
+
+def is_partitioned(table_name):
+    relkind_sql = f"""
+        select relkind::VARCHAR
+        from pg_class
+        where oid = to_regclass('{table_name}');
+    """
+    result = execute_sql(sql=relkind_sql)
+    return bool(result) and result[0][0] == 'p'
+
+
+def table_exists(table_name):
+    result = execute_sql(sql=f"select to_regclass('{table_name}') is not null;")
+    return result[0][0]
+
+
+def get_partition_dates(table_name, partition_prefix):
+    partitions_sql = f"""
+        select child.relname::VARCHAR
+        from pg_inherits
+        inner join pg_class as parent on pg_inherits.inhparent = parent.oid
+        inner join pg_class as child on pg_inherits.inhrelid = child.oid
+        where parent.oid = to_regclass('{table_name}');
+    """
+    partition_dates = {}
+    for (partition_name,) in execute_sql(sql=partitions_sql):
+        if not partition_name.startswith(partition_prefix):
+            continue
+        try:
+            partition_date = datetime.strptime(partition_name[len(partition_prefix):], "%Y_%m_%d")
+        except ValueError:
+            continue
+        partition_dates[partition_name] = partition_date.date()
+    return partition_dates
+
+
+def drop_expired_partitions(table_name, partition_prefix, retention_days, detach_only=False):
+    if retention_days is None:
+        return []
+
+    retention_horizon = (datetime.today() - timedelta(days=retention_days)).date()
+    expired_partitions = sorted(partition_name
+                                for partition_name, partition_date
+                                in get_partition_dates(table_name, partition_prefix).items()
+                                if partition_date < retention_horizon)
+
+    for partition_name in expired_partitions:
+        with transaction():
+            execute_sql(sql=f"ALTER TABLE {table_name} DETACH PARTITION {partition_name};")
+            if not detach_only:
+                execute_sql(sql=f"DROP TABLE {partition_name};")
+    return expired_partitions
+
+
+def convert_to_partitioned(table_name, partition_prefix, date_field, create_table):
+    # One-off migration of a plain heap into a table partitioned by day, run in a single transaction
+    if not table_exists(table_name) or is_partitioned(table_name):
+        return
+
+    unpartitioned_table_name = table_name + '_unpartitioned'
+    with transaction():
+        execute_sql(sql=f"ALTER TABLE {table_name} RENAME TO {unpartitioned_table_name};")
+        create_table(table_name)
+        existing_dates = execute_sql(sql=f"select distinct {date_field}::VARCHAR from {unpartitioned_table_name};")
+        for (date_stamp,) in existing_dates:
+            create_partition(table_name, partition_prefix, date_stamp)
+        execute_sql(sql=f"INSERT INTO {table_name} SELECT * FROM {unpartitioned_table_name};")
+        execute_sql(sql=f"DROP TABLE {unpartitioned_table_name};")
+
+
+def maintain_table(table_name, partition_prefix, retention_days=None, days_ahead=PARTITIONS_AHEAD_DAYS):
+    with transaction():
+        create_indexes(table_name)
+    precreate_partitions(table_name, partition_prefix, days_ahead)
+    drop_expired_partitions(table_name, partition_prefix, retention_days)
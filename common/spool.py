@@ -0,0 +1,172 @@
+import os
+import gzip
+import json
+import uuid
+import logging
+import threading
+from datetime import datetime
+
+from common.db_operations import execute_sql, transaction
+from common.instrumentation import stage
+
+# Global constants
+SPOOL_DIR = os.environ.get('PG_SPOOL_DIR',
+                           os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'spool'))
+SPOOL_TABLE_NAME = 'etl_spool_segments'
+SEGMENT_SUFFIX = '.ndjson.gz'
+FLUSH_INTERVAL_SECONDS = 5
+FLUSH_BATCH_RECORDS = 50000
+FLUSH_STOP_TIMEOUT_SECONDS = int(os.environ.get('PG_SPOOL_STOP_TIMEOUT_SECONDS', 300))
+
+logger = logging.getLogger(__name__)
+
+
+def _stream_dir(stream_name):
+    return os.path.join(SPOOL_DIR, stream_name)
+
+
+def write_segment(stream_name, records):
+    # Append-only: a segment becomes visible to the flusher only once it is complete and on disk
+    stream_dir = _stream_dir(stream_name)
+    os.makedirs(stream_dir, exist_ok=True)
+    segment_name = f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}_{uuid.uuid4().hex[:8]}{SEGMENT_SUFFIX}"
+    segment_path = os.path.join(stream_dir, segment_name)
+    tmp_path = segment_path + '.tmp'
+    with open(tmp_path, 'wb') as raw_file:
+        with gzip.GzipFile(fileobj=raw_file, mode='wb') as file:
+            for record in records:
+                file.write(json.dumps(record, default=str).encode())
+                file.write(b'\n')
+        raw_file.flush()
+        os.fsync(raw_file.fileno())
+    os.replace(tmp_path, segment_path)
+    return segment_name
+
+
+def pending_segments(stream_name):
+    try:
+        segment_names = os.listdir(_stream_dir(stream_name))
+    except FileNotFoundError:
+        return []
+    return sorted(segment_name for segment_name in segment_names if segment_name.endswith(SEGMENT_SUFFIX))
+
+
+def read_segment(stream_name, segment_name):
+    with gzip.open(os.path.join(_stream_dir(stream_name), segment_name), 'rt') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def create_spool_table():
+    create_sql = f"""
+        CREATE TABLE IF NOT EXISTS {SPOOL_TABLE_NAME} (
+            stream VARCHAR,
+            segment VARCHAR,
+            loaded_at TIMESTAMP DEFAULT now(),
+            PRIMARY KEY (stream, segment));
+    """
+    execute_sql(sql=create_sql)
+
+
+def _claim_segments(stream_name, segment_names):
+    # Segments already claimed by an earlier flush (e.g. one that died before deleting its files) are skipped
+    claim_sql = f"""
+        insert into {SPOOL_TABLE_NAME}(stream, segment)
+        select '{stream_name}', segment
+        from unnest(array[{', '.join(f"'{segment_name}'" for segment_name in segment_names)}]::VARCHAR[]) as segments(segment)
+        on conflict do nothing
+        returning segment;
+    """
+    return set(segment for (segment,) in execute_sql(sql=claim_sql))
+
+
+def _load_batch(stream_name, batch, load_function):
+    with stage('spool_flush', detail=stream_name) as counters:
+        with transaction():
+            create_spool_table()
+            claimed_segments = _claim_segments(stream_name, [segment_name for segment_name, _ in batch])
+            records = [record for segment_name, segment_records in batch
+                       if segment_name in claimed_segments
+                       for record in segment_records]
+            if records:
+                load_function(records)
+        counters['rows'] = len(records)
+
+    for segment_name, _ in batch:
+        try:
+            os.remove(os.path.join(_stream_dir(stream_name), segment_name))
+        except FileNotFoundError:
+            pass
+    return len(records)
+
+
+def flush_stream(stream_name, load_function, batch_records=FLUSH_BATCH_RECORDS):
+    # Replays the backlog oldest first; each batch is loaded and claimed in one transaction
+    loaded_records = 0
+    batch = []
+    batch_size = 0
+    for segment_name in pending_segments(stream_name):
+        try:
+            segment_records = read_segment(stream_name, segment_name)
+        except FileNotFoundError:
+            continue
+        batch.append((segment_name, segment_records))
+        batch_size += len(segment_records)
+        if batch_size >= batch_records:
+            loaded_records += _load_batch(stream_name, batch, load_function)
+            batch = []
+            batch_size = 0
+    if batch:
+        loaded_records += _load_batch(stream_name, batch, load_function)
+    return loaded_records
+
+
+class SpoolFlusher:
+    # Background loader: streams maps a stream name to {'load': f(records), 'prepare': f() or None,
+    # 'reset': f() or None, 'batch_records': int}. Failures keep the segments on disk for the next attempt
+    # and call reset, so a loader can drop state that the rolled back transaction never committed
+
+    def __init__(self, streams, interval_seconds=FLUSH_INTERVAL_SECONDS):
+        self.streams = streams
+        self.interval_seconds = interval_seconds
+        self.prepared_streams = set()
+        self.stop_event = threading.Event()
+        self.flushed = False
+        self.thread = threading.Thread(target=self._run, name='spool-flusher', daemon=True)
+
+    def flush(self):
+        flushed = True
+        for stream_name, stream in self.streams.items():
+            try:
+                if stream_name not in self.prepared_streams:
+                    if stream.get('prepare') is not None:
+                        stream['prepare']()
+                    self.prepared_streams.add(stream_name)
+                flush_stream(stream_name,
+                             stream['load'],
+                             stream.get('batch_records', FLUSH_BATCH_RECORDS))
+            except Exception:
+                logger.exception('Flushing spool stream %s failed, its segments stay queued', stream_name)
+                if stream.get('reset') is not None:
+                    stream['reset']()
+                flushed = False
+        return flushed
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.flush()
+            self.stop_event.wait(self.interval_seconds)
+        # Final flush after the writers are done, so a healthy database ends the run fully loaded
+        self.flushed = self.flush()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self, timeout_seconds=FLUSH_STOP_TIMEOUT_SECONDS):
+        # Bounded, so a hung database can't hold up the run; an unfinished flush leaves its segments spooled
+        self.stop_event.set()
+        self.thread.join(timeout_seconds)
+        if self.thread.is_alive():
+            logger.error('Spool flusher still running after %ss, leaving its segments queued', timeout_seconds)
+            return False
+        return self.flushed
@@ -1,16 +1,40 @@
 import os
 import sys
-import json
-from datetime import datetime
+import uuid
+import hashlib
+from datetime import datetime, timedelta
+from functools import partial
 
-from news_sites_extract_modules.title_list_scraper import get_title_list_from_site
-from common.db_operations import execute_sql, create_partition
+from news_sites_extract_modules.title_list_scraper import (get_title_lists_from_sites, load_site_list,
+                                                           load_page_cache, save_page_cache)
+from common.instrumentation import run_pipeline
+from common.db_operations import execute_sql, insert_rows, create_partition, transaction, close_pool
+from common.spool import write_segment, SpoolFlusher
 
 # Global constants
 TABLE_NAME_BASE = 'scraped_titles'
 PARTITION_PREFIX_BASE ='st_'
+INTERVAL_TABLE_NAME_BASE = 'scraped_title_intervals'
 SITE_LIST_PATH = os.path.dirname(os.path.abspath(__file__)) + '/news_sites_extract_modules/'
 SITE_LIST_PARSE_LOGIC_FILE = SITE_LIST_PATH + 'site_list.json'
+SCRAPE_WORKERS = 8
+INSERT_METHOD = 'copy'
+BUFFER_RUN_INSERTS = True
+SKIP_UNCHANGED_INSERTS = False  # True skips sites whose front page is unchanged since the last run
+# 'sightings' (row per title per run, read as scraped_titles) or 'intervals' (first/last seen per title).
+# Switching to 'intervals' stops writes to scraped_titles and nothing migrates its rows or keeps its shape for readers
+TITLE_STORAGE_MODE = 'sightings'
+SPOOL_WRITES = True  # Scrapes go to the local spool and a background flusher loads them
+SPOOL_STREAM_BASE = 'news_titles'
+INTERVAL_SPOOL_STREAM_BASE = 'news_title_intervals'
+INSERT_COLUMNS = ('scrape_date', 'scrape_time', 'site', 'title')
+INTERVAL_INSERT_COLUMNS = ('site', 'title_hash', 'title', 'first_seen_at', 'last_seen_at')
+SCRAPE_INTERVAL_MINUTES = 60  # Hourly schedule
+SCRAPE_INTERVAL_SLACK_MINUTES = 15  # Tolerated drift before a missed scrape is assumed
+
+# In-process fingerprint index of the titles currently on each site's page:
+# site -> (last scrape timestamp, set of title hashes seen at that scrape)
+_open_titles = {}
 
 
 def create_table(table_name):
@@ -25,41 +49,239 @@ def create_table(table_name):
     execute_sql(sql=create_sql)
 
 
-def insert_data(table_name, date_stamp, time_stamp, site, title_list):
+def create_interval_table(interval_table_name):
+    # One row per uninterrupted run of a title on a site's front page
+    create_sql = f"""
+        CREATE TABLE IF NOT EXISTS {interval_table_name} (
+            site VARCHAR,
+            title_hash UUID,
+            title VARCHAR,
+            first_seen_at TIMESTAMP,
+            last_seen_at TIMESTAMP,
+            PRIMARY KEY (site, title_hash, first_seen_at));
+        CREATE INDEX IF NOT EXISTS {interval_table_name}_site_last_seen_idx
+            ON {interval_table_name} (site, last_seen_at);
+    """
+    execute_sql(sql=create_sql)
+
+
+def build_rows(date_stamp, time_stamp, site, title_list):
     rows = []
     for title in title_list:
         rows.append([date_stamp, time_stamp, site, title])
-    insert_sql = f"""
-        INSERT INTO {table_name}
-            (scrape_date,scrape_time,site,title)
-            VALUES (%s,%s,%s,%s)
+    return rows
+
+
+def insert_data(table_name, date_stamp, time_stamp, site, title_list, method=INSERT_METHOD):
+    insert_rows(table_name,
+                columns=INSERT_COLUMNS,
+                rows=build_rows(date_stamp, time_stamp, site, title_list),
+                method=method)
+
+
+def title_fingerprint(title):
+    return str(uuid.UUID(hashlib.md5(title.encode()).hexdigest()))
+
+
+def load_open_titles(interval_table_name, sites):
+    sites = [site for site in sites if site not in _open_titles]
+    if not sites:
+        return
+
+    site_list_sql = ', '.join(f"'{site}'" for site in sites)
+    open_titles_sql = f"""
+        with latest_scrapes as (
+            select
+                site,
+                (select max(last_seen_at)
+                 from {interval_table_name} as intervals
+                 where intervals.site = sites.site) as last_seen_at
+            from unnest(array[{site_list_sql}]::VARCHAR[]) as sites(site)
+        )
+
+        select
+            intervals.site,
+            intervals.title_hash::VARCHAR,
+            intervals.last_seen_at
+        from {interval_table_name} as intervals
+        inner join latest_scrapes
+        on intervals.site = latest_scrapes.site
+        and intervals.last_seen_at = latest_scrapes.last_seen_at;
     """
-    execute_sql(sql=insert_sql, rows=rows)
+    open_titles = {site: (None, set()) for site in sites}
+    for site, title_hash, last_seen_at in execute_sql(sql=open_titles_sql):
+        open_titles[site] = (last_seen_at, open_titles[site][1] | {title_hash})
+    _open_titles.update(open_titles)
+
+
+def forget_open_titles():
+    _open_titles.clear()
+
+
+def record_title_intervals(interval_table_name, site_scrapes, method=INSERT_METHOD):
+    # Titles still on the page extend their open interval; new or returning titles open a new one.
+    # After a missed scrape nothing is known about the gap, so every title opens a new interval
+    max_gap = timedelta(minutes=SCRAPE_INTERVAL_MINUTES + SCRAPE_INTERVAL_SLACK_MINUTES)
+    new_interval_rows = []
+    updated_open_titles = {}
+
+    with transaction():
+        for site, scraped_at, title_list in site_scrapes:
+            previous_scraped_at, previous_hashes = _open_titles.get(site, (None, set()))
+            if previous_scraped_at is None or scraped_at - previous_scraped_at > max_gap:
+                previous_hashes = set()
+            current_titles = {title_fingerprint(title): title for title in title_list}
+            continuing_hashes = sorted(set(current_titles) & previous_hashes)
+
+            if continuing_hashes:
+                extend_sql = f"""
+                    UPDATE {interval_table_name}
+                    SET last_seen_at = %s
+                    WHERE site = %s
+                    AND last_seen_at = %s
+                    AND title_hash = ANY(%s::UUID[])
+                """
+                execute_sql(sql=extend_sql,
+                            rows=[(scraped_at, site, previous_scraped_at, continuing_hashes)])
 
+            for title_hash, title in current_titles.items():
+                if title_hash not in previous_hashes:
+                    new_interval_rows.append((site, title_hash, title, scraped_at, scraped_at))
+            updated_open_titles[site] = (scraped_at, set(current_titles))
 
-def pipeline(is_test):
+        if new_interval_rows:
+            insert_rows(interval_table_name,
+                        columns=INTERVAL_INSERT_COLUMNS,
+                        rows=new_interval_rows,
+                        method=method)
+
+    _open_titles.update(updated_open_titles)
+
+
+def get_titles_on_page(interval_table_name, site, hour_start):
+    titles_sql = f"""
+        select title
+        from {interval_table_name}
+        where site = '{site}'
+        and first_seen_at < '{hour_start}'::TIMESTAMP + interval '1 hour'
+        and last_seen_at >= '{hour_start}'::TIMESTAMP
+        order by first_seen_at, title;
+    """
+    return [title for (title,) in execute_sql(sql=titles_sql)]
+
+
+def prepare_tables(table_name, interval_table_name):
+    with transaction():
+        if TITLE_STORAGE_MODE == 'intervals':
+            create_interval_table(interval_table_name)
+        else:
+            create_table(table_name)
+
+
+def load_spooled_rows(table_name, partition_prefix, rows):
+    for date_stamp in sorted(set(row[0] for row in rows)):
+        create_partition(table_name, partition_prefix, date_stamp)
+    insert_rows(table_name,
+                columns=INSERT_COLUMNS,
+                rows=rows,
+                method=INSERT_METHOD)
+
+
+def load_spooled_scrapes(interval_table_name, scrapes):
+    # Called once per spooled run; the index stays warm across runs and is only re-read
+    # for sites it doesn't hold, or after a failed flush has cleared it
+    site_scrapes = [(site, datetime.fromisoformat(scraped_at), title_list)
+                    for site, scraped_at, title_list in scrapes]
+    load_open_titles(interval_table_name, sorted(set(site for site, _, _ in site_scrapes)))
+    record_title_intervals(interval_table_name, site_scrapes)
+
+
+def pipeline(is_test, site_list_with_parse_logic=None):
     table_name = TABLE_NAME_BASE if not is_test else 'test_' + TABLE_NAME_BASE
     partition_prefix = PARTITION_PREFIX_BASE if not is_test else 'test_' + PARTITION_PREFIX_BASE
+    interval_table_name = INTERVAL_TABLE_NAME_BASE if not is_test else 'test_' + INTERVAL_TABLE_NAME_BASE
+    spool_stream = INTERVAL_SPOOL_STREAM_BASE if TITLE_STORAGE_MODE == 'intervals' else SPOOL_STREAM_BASE
+    spool_stream = spool_stream if not is_test else 'test_' + spool_stream
     date_stamp = datetime.today().strftime("%Y-%m-%d")
 
-    create_table(table_name)
-    create_partition(table_name, partition_prefix, date_stamp)
+    if not SPOOL_WRITES:
+        prepare_tables(table_name, interval_table_name)
+        if TITLE_STORAGE_MODE != 'intervals':
+            create_partition(table_name, partition_prefix, date_stamp)
+
+    if site_list_with_parse_logic is None:
+        site_list_with_parse_logic = load_site_list(SITE_LIST_PARSE_LOGIC_FILE)
+
+    if is_test: site_list_with_parse_logic = site_list_with_parse_logic[:1]
+
+    if TITLE_STORAGE_MODE == 'intervals' and not SPOOL_WRITES:
+        load_open_titles(interval_table_name, [site['name'] for site in site_list_with_parse_logic])
+
+    flusher = None
+    if SPOOL_WRITES:
+        if TITLE_STORAGE_MODE == 'intervals':
+            stream = {'load': partial(load_spooled_scrapes, interval_table_name),
+                      'reset': forget_open_titles,
+                      'batch_records': 1}
+        else:
+            stream = {'load': partial(load_spooled_rows, table_name, partition_prefix)}
+        stream['prepare'] = partial(prepare_tables, table_name, interval_table_name)
+        flusher = SpoolFlusher({spool_stream: stream}).start()
+
+    run_buffer = []
+    site_scrapes = []
+    load_page_cache()
+
+    try:
+        for site_with_parse_logic, title_list, changed in get_title_lists_from_sites(site_list_with_parse_logic,
+                                                                                     max_workers=SCRAPE_WORKERS):
+            if TITLE_STORAGE_MODE == 'intervals':
+                site_scrapes.append((site_with_parse_logic['name'],
+                                     datetime.now().replace(microsecond=0),
+                                     title_list))
+                continue
+            if SKIP_UNCHANGED_INSERTS and not changed:
+                continue
+            time_stamp = datetime.now().strftime("%H:%M:%S")
+            if BUFFER_RUN_INSERTS or SPOOL_WRITES:
+                run_buffer += build_rows(date_stamp,
+                                         time_stamp,
+                                         site_with_parse_logic['name'],
+                                         title_list)
+            else:
+                insert_data(table_name,
+                            date_stamp,
+                            time_stamp,
+                            site_with_parse_logic['name'],
+                            title_list)
+
+        save_page_cache()
+
+        if SPOOL_WRITES:
+            if site_scrapes or run_buffer:
+                write_segment(spool_stream, site_scrapes or run_buffer)
+        else:
+            if site_scrapes:
+                record_title_intervals(interval_table_name, site_scrapes)
 
-    with open(SITE_LIST_PARSE_LOGIC_FILE, 'r') as file:
-        site_list_with_parse_logic = json.load(file)
+            if run_buffer:
+                insert_rows(table_name,
+                            columns=INSERT_COLUMNS,
+                            rows=run_buffer,
+                            method=INSERT_METHOD)
+    finally:
+        if flusher is not None:
+            flushed = flusher.stop()
 
-    for site_with_parse_logic in site_list_with_parse_logic:
-        time_stamp = datetime.now().strftime("%H:%M:%S")
-        title_list = get_title_list_from_site(site_with_parse_logic)
-        insert_data(table_name,
-                    date_stamp,
-                    time_stamp,
-                    site_with_parse_logic['name'],
-                    title_list)
-        
-        if is_test: break
+    if flusher is not None and not flushed:
+        # Report the run as failed rather than as a complete scrape
+        raise RuntimeError(f"Spool stream {spool_stream} did not drain, its segments stay queued")
 
 
 if __name__ == '__main__':
     is_test = any(test_flag in sys.argv for test_flag in ['test', '--test'])
-    pipeline(is_test)
+    profile = any(profile_flag in sys.argv for profile_flag in ['profile', '--profile'])
+    try:
+        run_pipeline('extract_news_titles', pipeline, is_test, profile=profile)
+    finally:
+        close_pool()
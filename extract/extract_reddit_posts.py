@@ -1,19 +1,51 @@
 import sys
+import logging
 from datetime import datetime
+from functools import partial
 
-from common.db_operations import execute_sql, create_partition
-from reddit_posts_extract_modules.reddit_api_interface import api_auth, fetch_posts
+import psycopg2
+
+from common.instrumentation import run_pipeline
+from common.db_operations import (execute_sql, insert_rows, transaction, close_pool, create_partition,
+                                  create_watermark_table, record_watermarks, invalidate_watermarks,
+                                  following_date_hours)
+from common.schema_management import maintain_table, get_partition_dates
+from common.spool import write_segment, SpoolFlusher
+from common.compact_storage import (is_compact, compact_table_name, compact_partition_prefix, migrate_to_compact,
+                                    drop_legacy_table, get_subreddit_ids, encode_post_id, epoch_to_timestamp, ratio_to_permille)
+from reddit_posts_extract_modules.reddit_api_interface import api_auth, fetch_posts_concurrently
 
 # Global constants
-POSTS_TO_FETCH = 100
+POSTS_TO_FETCH = 100  # Hourly snapshot window, always fetched in full
+MAX_POSTS_TO_FETCH = 1000  # Paging cap while catching up to the previous run's newest post
+FETCH_WORKERS = 8
+INSERT_METHOD = 'copy'
+BUFFER_RUN_INSERTS = True
+SPOOL_WRITES = True  # Fetched rows go to the local spool and a background flusher loads them
+SPOOL_STREAM_BASE = 'reddit_posts'
 TABLE_NAME_BASE = 'reddit_data'
 PARTITION_PREFIX_BASE = "rd_"
+DATE_FIELD = 'apicall_date'
+CURSOR_TABLE_NAME_BASE = 'reddit_fetch_cursors'
+DOWNSTREAM_TABLE_NAME_BASES = ('fct_reddit_snapshots_hourly', 'fct_reddit_posts_latest')
+PAIRED_DOWNSTREAM_TABLE_NAME_BASES = ('agg_subreddit_metrics_hourly',)  # Also pairs each hour with the one before
+PARTITION_RETENTION_DAYS = None  # None keeps every partition; must stay above the transform lookback
 SUBREDDITS = ('australia,unitedkingdom,russia,poland,india,canada,germany,'
               'france,dataisbeautiful,funny,gaming,aww,Music,pics,'
               'worldnews,science,todayilearned,movies,videos,news,'
               'Showerthoughts,EarthPorn,hungary,datascience,romania,'
               'czech,Austria,de,europe,Polska,wallstreetbets,memes,'
               'nosleep,personalfinance,politics')
+INSERT_COLUMNS = ('subreddit', 'name', 'ups', 'created_utc', 'upvote_ratio',
+                  'num_comments', 'total_awards_received', 'post_rank',
+                  'apicall_date', 'apicall_time', 'created_at', 'downs',
+                  'apicall_hour')
+# Compact storage layout, widest types first so rows need no alignment padding
+COMPACT_INSERT_COLUMNS = ('post_id', 'created_at', 'apicall_time', 'apicall_date', 'ups', 'downs',
+                          'num_comments', 'total_awards_received', 'subreddit_id', 'apicall_hour',
+                          'post_rank', 'upvote_ratio_permille')
+
+logger = logging.getLogger(__name__)
 
 
 def create_table(table_name):
@@ -30,81 +62,389 @@ def create_table(table_name):
             num_comments INTEGER,
             total_awards_received INTEGER,
             post_rank SMALLINT,
-            created_at VARCHAR)
+            created_at VARCHAR,
+            apicall_hour SMALLINT)
         PARTITION BY RANGE (apicall_date);
     """
     execute_sql(sql=create_sql)
+    # Tables created before apicall_hour existed; adding a nullable column is catalog-only
+    execute_sql(sql=f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS apicall_hour SMALLINT;")
 
 
-def insert_data(table_name, filtered_enriched_post_list):
-    insert_sql = f"""
-        INSERT INTO {table_name}
-            (subreddit,name,ups,created_utc,upvote_ratio,num_comments,
-             total_awards_received,post_rank,apicall_date,apicall_time,
-             created_at,downs)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+def create_compact_table(compact_name):
+    create_sql = f"""
+        CREATE TABLE IF NOT EXISTS {compact_name} (
+            post_id BIGINT,
+            created_at TIMESTAMPTZ,
+            apicall_time TIME,
+            apicall_date DATE,
+            ups INTEGER,
+            downs INTEGER,
+            num_comments INTEGER,
+            total_awards_received INTEGER,
+            subreddit_id SMALLINT,
+            apicall_hour SMALLINT,
+            post_rank SMALLINT,
+            upvote_ratio_permille SMALLINT)
+        PARTITION BY RANGE (apicall_date);
     """
-    execute_sql(sql=insert_sql, rows=filtered_enriched_post_list)
+    execute_sql(sql=create_sql)
 
 
-def filter_enrich_post_list(post_list):
-    post_fields_to_keep = ['subreddit', 'name', 'ups', 'created_utc',
-                           'upvote_ratio', 'num_comments',
-                           'total_awards_received']
-    filtered_enriched_post_list = []
-    post_rank = 1
+def copy_partition_to_compact_sql(partition_name, compact_name):
+    return f"""
+        insert into {compact_name}({', '.join(COMPACT_INSERT_COLUMNS)})
+        select
+            reddit_id_to_bigint(legacy.name),
+            to_timestamp(legacy.created_utc),
+            legacy.apicall_time,
+            legacy.apicall_date,
+            legacy.ups,
+            legacy.downs,
+            legacy.num_comments,
+            legacy.total_awards_received,
+            subreddits.subreddit_id,
+            coalesce(legacy.apicall_hour, extract(hour from legacy.apicall_time)),
+            legacy.post_rank,
+            round(legacy.upvote_ratio * 1000)
+        from {partition_name} as legacy
+        left join dim_subreddits as subreddits
+        on legacy.subreddit = subreddits.subreddit;
+    """
 
-    for post in post_list:
-        filtered_enriched_post = []
-        for field in post_fields_to_keep:
-            if field in post['data'].keys():
-                filtered_enriched_post.append(post['data'][field])
-            else:
-                filtered_enriched_post.append(None)
 
-        filtered_enriched_post.append(post_rank)
-        filtered_enriched_post.append(datetime.now().strftime('%Y-%m-%d'))
-        filtered_enriched_post.append(datetime.now().strftime('%H:%M:%S'))
-        filtered_enriched_post.append(
-            datetime.fromtimestamp(post['data']['created_utc'])
-            .strftime('%Y-%m-%d %H:%M:%S'))
+def create_compatibility_views(table_name, compact_name):
+    # Same columns, order and text formats as the legacy table; inserts are re-encoded by the trigger
+    create_sql = f"""
+        CREATE OR REPLACE VIEW {table_name} AS
+        select
+            compact.apicall_date,
+            compact.apicall_time,
+            subreddits.subreddit,
+            reddit_id_to_name(compact.post_id) as name,
+            compact.ups,
+            compact.downs,
+            extract(epoch from compact.created_at)::FLOAT as created_utc,
+            compact.upvote_ratio_permille / 1000::FLOAT as upvote_ratio,
+            compact.num_comments,
+            compact.total_awards_received,
+            compact.post_rank,
+            to_char(compact.created_at at time zone 'UTC', 'YYYY-MM-DD HH24:MI:SS')::VARCHAR as created_at,
+            compact.apicall_hour
+        from {compact_name} as compact
+        left join dim_subreddits as subreddits
+        on compact.subreddit_id = subreddits.subreddit_id;
+
+        CREATE OR REPLACE FUNCTION {table_name}_insert() RETURNS TRIGGER AS $$
+        BEGIN
+            INSERT INTO {compact_name}({', '.join(COMPACT_INSERT_COLUMNS)})
+            VALUES (reddit_id_to_bigint(NEW.name),
+                    to_timestamp(NEW.created_utc),
+                    NEW.apicall_time,
+                    NEW.apicall_date,
+                    NEW.ups,
+                    NEW.downs,
+                    NEW.num_comments,
+                    NEW.total_awards_received,
+                    subreddit_to_id(NEW.subreddit),
+                    NEW.apicall_hour,
+                    NEW.post_rank,
+                    round(NEW.upvote_ratio * 1000));
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER {table_name}_insert
+        INSTEAD OF INSERT ON {table_name}
+        FOR EACH ROW EXECUTE FUNCTION {table_name}_insert();
+    """
+    execute_sql(sql=create_sql)
+
+
+def migrate_to_compact_storage(table_name, partition_prefix):
+    migrate_to_compact(table_name,
+                       partition_prefix,
+                       compact_partition_prefix(partition_prefix),
+                       create_compact_table=create_compact_table,
+                       copy_partition_sql=copy_partition_to_compact_sql,
+                       create_compatibility_views=create_compatibility_views)
+
+
+def storage_target(table_name, partition_prefix):
+    # (physical table, its partition prefix, compact?) for the logical table name
+    if is_compact(table_name):
+        return compact_table_name(table_name), compact_partition_prefix(partition_prefix), True
+    return table_name, partition_prefix, False
+
+
+def encode_compact_rows(filtered_enriched_post_list):
+    column_index = {column: index for index, column in enumerate(INSERT_COLUMNS)}
+    subreddit_ids = get_subreddit_ids(row[column_index['subreddit']] for row in filtered_enriched_post_list)
+    return [(encode_post_id(row[column_index['name']]),
+             epoch_to_timestamp(row[column_index['created_utc']]),
+             row[column_index['apicall_time']],
+             row[column_index['apicall_date']],
+             row[column_index['ups']],
+             row[column_index['downs']],
+             row[column_index['num_comments']],
+             row[column_index['total_awards_received']],
+             subreddit_ids.get(row[column_index['subreddit']]),
+             row[column_index['apicall_hour']],
+             row[column_index['post_rank']],
+             ratio_to_permille(row[column_index['upvote_ratio']]))
+            for row in filtered_enriched_post_list]
+
+
+def migrate_hour_column(table_name, partition_prefix):
+    for partition_name in sorted(get_partition_dates(table_name, partition_prefix)):
+        backfill_sql = f"""
+            UPDATE {partition_name}
+            SET apicall_hour = extract(hour from apicall_time)
+            WHERE apicall_hour IS NULL;
+        """
+        execute_sql(sql=backfill_sql)
+    execute_sql(sql=f"DROP INDEX IF EXISTS {table_name}_date_hour_idx;")
+
+
+def create_cursor_table(cursor_table_name):
+    create_sql = f"""
+        CREATE TABLE IF NOT EXISTS {cursor_table_name} (
+            subreddit VARCHAR PRIMARY KEY,
+            post_name VARCHAR,
+            post_created_utc FLOAT,
+            updated_at TIMESTAMP DEFAULT now());
+    """
+    execute_sql(sql=create_sql)
 
-        d = post['data']  # Single letter variable for readability
-        downs_est = int(
-            (d['ups'] - d['ups']*d['upvote_ratio']) / d['upvote_ratio'])
 
-        filtered_enriched_post.append(downs_est)
+def load_fetch_cursors(cursor_table_name):
+    cursor_rows = execute_sql(sql=f"select subreddit, post_name, post_created_utc from {cursor_table_name};")
+    return {subreddit: (post_name, post_created_utc)
+            for subreddit, post_name, post_created_utc in cursor_rows}
 
-        filtered_enriched_post_list.append(filtered_enriched_post)
-        post_rank += 1
+
+def newest_post_cursor(filtered_enriched_post_list):
+    name_index = INSERT_COLUMNS.index('name')
+    created_utc_index = INSERT_COLUMNS.index('created_utc')
+    dated_rows = [row for row in filtered_enriched_post_list if row[created_utc_index] is not None]
+    if not dated_rows:
+        return None
+    newest_row = max(dated_rows, key=lambda row: row[created_utc_index])
+    return newest_row[name_index], newest_row[created_utc_index]
+
+
+def save_fetch_cursors(cursor_table_name, fetch_cursors):
+    if not fetch_cursors:
+        return
+    upsert_sql = f"""
+        INSERT INTO {cursor_table_name} AS cursors (subreddit, post_name, post_created_utc)
+            VALUES (%s,%s,%s)
+        ON CONFLICT (subreddit) DO UPDATE
+            SET post_name = excluded.post_name,
+                post_created_utc = excluded.post_created_utc,
+                updated_at = now()
+            WHERE excluded.post_created_utc >= cursors.post_created_utc
+    """
+    execute_sql(sql=upsert_sql,
+                rows=[(subreddit, post_name, post_created_utc)
+                      for subreddit, (post_name, post_created_utc) in sorted(fetch_cursors.items())])
+
+
+def insert_data(table_name, filtered_enriched_post_list, method=INSERT_METHOD):
+    date_index = INSERT_COLUMNS.index('apicall_date')
+    hour_index = INSERT_COLUMNS.index('apicall_hour')
+    date_hours = sorted(set((row[date_index], row[hour_index])
+                            for row in filtered_enriched_post_list))
+    with transaction():
+        if is_compact(table_name):
+            insert_rows(compact_table_name(table_name),
+                        columns=COMPACT_INSERT_COLUMNS,
+                        rows=encode_compact_rows(filtered_enriched_post_list),
+                        method=method)
+        else:
+            insert_rows(table_name,
+                        columns=INSERT_COLUMNS,
+                        rows=filtered_enriched_post_list,
+                        method=method)
+        record_watermarks(table_name, date_hours)
+        invalidate_downstream_watermarks(table_name, date_hours)
+
+
+def invalidate_downstream_watermarks(table_name, date_hours):
+    # Rows can land after the transforms already processed their hour (e.g. a spool backlog replayed
+    # a run later); dropping the downstream watermarks in the same transaction makes them redo it
+    table_prefix = table_name[:-len(TABLE_NAME_BASE)]
+    invalidate_watermarks([table_prefix + table_name_base for table_name_base in DOWNSTREAM_TABLE_NAME_BASES],
+                          date_hours)
+    invalidate_watermarks([table_prefix + table_name_base for table_name_base in PAIRED_DOWNSTREAM_TABLE_NAME_BASES],
+                          sorted(set(date_hours) | set(following_date_hours(date_hours))))
+
+
+def _format_created_at(created_utc):
+    if created_utc is None:
+        return None
+    return datetime.fromtimestamp(int(created_utc)).isoformat(sep=' ')
+
+
+def _estimate_downs(ups, upvote_ratio):
+    if ups is None or not upvote_ratio:
+        return None
+    return int((ups - ups*upvote_ratio) / upvote_ratio)
+
+
+def filter_enrich_post_list(post_list, snapshot_time=None):
+    # One timestamp per API call, so every row of a snapshot carries the same date, time and hour
+    snapshot_time = snapshot_time or datetime.now()
+    apicall_date = snapshot_time.strftime('%Y-%m-%d')
+    apicall_time = snapshot_time.strftime('%H:%M:%S')
+    apicall_hour = snapshot_time.hour
+
+    filtered_enriched_post_list = []
+    for post_rank, post in enumerate(post_list, start=1):
+        d = post['data']  # Single letter variable for readability
+        ups = d.get('ups')
+        created_utc = d.get('created_utc')
+        upvote_ratio = d.get('upvote_ratio')
+
+        # Same order as INSERT_COLUMNS
+        filtered_enriched_post_list.append((
+            d.get('subreddit'),
+            d.get('name'),
+            ups,
+            created_utc,
+            upvote_ratio,
+            d.get('num_comments'),
+            d.get('total_awards_received'),
+            post_rank,
+            apicall_date,
+            apicall_time,
+            _format_created_at(created_utc),
+            _estimate_downs(ups, upvote_ratio),
+            apicall_hour))
 
     return filtered_enriched_post_list
 
 
-def pipeline(is_test):
+def prepare_tables(table_name, partition_prefix, cursor_table_name):
+    physical_table_name, physical_partition_prefix, compact = storage_target(table_name, partition_prefix)
+    with transaction():
+        if not compact:
+            create_table(table_name)
+        create_watermark_table()
+        create_cursor_table(cursor_table_name)
+    maintain_table(physical_table_name, physical_partition_prefix, retention_days=PARTITION_RETENTION_DAYS)
+
+
+def load_seen_cursors(cursor_table_name):
+    # Without the database the run still captures everything, it just pages up to MAX_POSTS_TO_FETCH
+    try:
+        with transaction():
+            create_cursor_table(cursor_table_name)
+            return load_fetch_cursors(cursor_table_name)
+    except psycopg2.OperationalError:
+        logger.warning('Could not load fetch cursors from %s, fetching without them', cursor_table_name)
+        return {}
+
+
+def load_spooled_rows(table_name, partition_prefix, cursor_table_name, rows):
+    # Runs inside the flusher's transaction, together with the claim of the segments
+    rows = [tuple(row) for row in rows]
+    subreddit_index = INSERT_COLUMNS.index('subreddit')
+    date_index = INSERT_COLUMNS.index('apicall_date')
+
+    rows_by_subreddit = {}
+    for row in rows:
+        rows_by_subreddit.setdefault(row[subreddit_index], []).append(row)
+    fetch_cursors = {}
+    for subreddit, subreddit_rows in rows_by_subreddit.items():
+        fetch_cursor = newest_post_cursor(subreddit_rows)
+        if fetch_cursor is not None:
+            fetch_cursors[subreddit] = fetch_cursor
+
+    physical_table_name, physical_partition_prefix, _ = storage_target(table_name, partition_prefix)
+    for apicall_date in sorted(set(row[date_index] for row in rows)):
+        create_partition(physical_table_name, physical_partition_prefix, apicall_date)
+    insert_data(table_name, rows)
+    save_fetch_cursors(cursor_table_name, fetch_cursors)
+
+
+def pipeline(is_test, migrate=False, compact=False, drop_legacy=False):
     table_name = TABLE_NAME_BASE if not is_test else 'test_' + TABLE_NAME_BASE
     partition_prefix = PARTITION_PREFIX_BASE if not is_test else 'test_' + PARTITION_PREFIX_BASE
-    date_stamp = datetime.today().strftime("%Y-%m-%d")
-    
-    create_table(table_name)
-    create_partition(table_name, partition_prefix, date_stamp)
+    cursor_table_name = CURSOR_TABLE_NAME_BASE if not is_test else 'test_' + CURSOR_TABLE_NAME_BASE
+    spool_stream = SPOOL_STREAM_BASE if not is_test else 'test_' + SPOOL_STREAM_BASE
+
+    if migrate or compact or not SPOOL_WRITES:
+        prepare_tables(table_name, partition_prefix, cursor_table_name)
+    if migrate and not is_compact(table_name):
+        migrate_hour_column(table_name, partition_prefix)
+    if compact:
+        migrate_to_compact_storage(table_name, partition_prefix)
+        prepare_tables(table_name, partition_prefix, cursor_table_name)
+    if drop_legacy:
+        drop_legacy_table(table_name, partition_prefix, DATE_FIELD)
 
     subreddit_list = sorted(list(set(SUBREDDITS.split(','))))
+    if is_test: subreddit_list = subreddit_list[:1]
 
+    seen_cursors = load_seen_cursors(cursor_table_name)
     TOKEN = api_auth()
+    run_buffer = []
+    run_cursors = {}
+
+    flusher = None
+    if SPOOL_WRITES:
+        # Replays any backlog from earlier runs while this run is still fetching
+        flusher = SpoolFlusher({spool_stream: {
+            'load': partial(load_spooled_rows, table_name, partition_prefix, cursor_table_name),
+            'prepare': partial(prepare_tables, table_name, partition_prefix, cursor_table_name)}}).start()
 
-    for subreddit in subreddit_list:
-        post_list = fetch_posts(subreddit=subreddit,
-                                post_count=POSTS_TO_FETCH,
-                                TOKEN=TOKEN)
+    try:
+        for subreddit, filtered_enriched_post_list, snapshot_time in fetch_posts_concurrently(
+                subreddit_list=subreddit_list,
+                post_count=POSTS_TO_FETCH,
+                TOKEN=TOKEN,
+                max_workers=FETCH_WORKERS,
+                max_post_count=MAX_POSTS_TO_FETCH,
+                seen_cursors=seen_cursors,
+                row_builder=filter_enrich_post_list):
 
-        filtered_enriched_post_list = filter_enrich_post_list(post_list)
+            if SPOOL_WRITES:
+                if filtered_enriched_post_list:
+                    write_segment(spool_stream, filtered_enriched_post_list)
+                continue
+
+            fetch_cursor = newest_post_cursor(filtered_enriched_post_list)
+
+            if BUFFER_RUN_INSERTS:
+                run_buffer += filtered_enriched_post_list
+                if fetch_cursor is not None:
+                    run_cursors[subreddit] = fetch_cursor
+            else:
+                with transaction():
+                    insert_data(table_name, filtered_enriched_post_list)
+                    save_fetch_cursors(cursor_table_name, {subreddit: fetch_cursor} if fetch_cursor else {})
+    finally:
+        if flusher is not None:
+            flushed = flusher.stop()
 
-        insert_data(table_name, filtered_enriched_post_list)
+    if flusher is not None and not flushed:
+        # Dependent steps must not run on a partial hour; the segments stay queued for the next run
+        raise RuntimeError(f"Spool stream {spool_stream} did not drain, its segments stay queued")
 
-        if is_test: break
+    if run_buffer:
+        with transaction():
+            insert_data(table_name, run_buffer)
+            save_fetch_cursors(cursor_table_name, run_cursors)
 
 
 if __name__ == '__main__':
     is_test = any(test_flag in sys.argv for test_flag in ['test', '--test'])
-    pipeline(is_test)
+    migrate = any(migrate_flag in sys.argv for migrate_flag in ['migrate', '--migrate'])
+    compact = any(compact_flag in sys.argv for compact_flag in ['compact', '--compact'])
+    drop_legacy = any(drop_legacy_flag in sys.argv for drop_legacy_flag in ['drop-legacy', '--drop-legacy'])
+    profile = any(profile_flag in sys.argv for profile_flag in ['profile', '--profile'])
+    try:
+        run_pipeline('extract_reddit_posts', pipeline, is_test, migrate, compact, drop_legacy, profile=profile)
+    finally:
+        close_pool()
@@ -1,40 +1,324 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from html.parser import HTMLParser
+
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.dammit import UnicodeDammit
 from collections import OrderedDict
 
+from common.instrumentation import stage, count
+
+try:
+    import lxml  # noqa: F401
+    TREE_PARSER = 'lxml'
+except ImportError:
+    TREE_PARSER = 'html.parser'
+
+# Global constants
+REQUEST_TIMEOUT_SECONDS = (5, 20)
+HTTP_POOL_CONNECTIONS = 32
+HTTP_POOL_SIZE = 4
+PARSE_MODE = 'stream'  # 'stream' (single-pass tokenizer) or 'tree' (BeautifulSoup)
+PAGE_CACHE_PATH = os.environ.get('PG_PAGE_CACHE_PATH',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), '.page_cache.json'))
+PAGE_CACHE_MAX_ENTRIES = 256
+
+# Same conventions as BeautifulSoup's html.parser tree builder
+VOID_ELEMENTS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                           'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+NON_TEXT_ELEMENTS = frozenset(['script', 'style', 'template'])
+MULTI_VALUED_ATTRIBUTES = frozenset(['class', 'rel', 'rev', 'accept-charset',
+                                     'headers', 'accesskey', 'dropzone'])
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+
 
-def get_content(url):
-    headers = {'User-Agent': '''Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) \
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.headers.update({'User-Agent': '''Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) \
                                 AppleWebKit/537.36 (KHTML, like Gecko) \
-                                Chrome/50.0.2661.102 Safari/537.36'''}
-    page = requests.get(url, headers=headers)
-    return BeautifulSoup(page.content, 'html.parser')
+                                Chrome/50.0.2661.102 Safari/537.36'''})
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                  pool_maxsize=HTTP_POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+    return _session
+
+
+def compile_rules(rules):
+    # site_list.json rules are [tag name or 0, attrs dict or 0]; 0 means "any"
+    compiled_rules = []
+    by_tag = {}
+    any_tag = []
+    for rule_index, (tag_name, attrs) in enumerate(rules):
+        tag_name = None if tag_name == 0 else tag_name.lower()
+        attrs = () if attrs == 0 else tuple((attr.lower(), value) for attr, value in attrs.items())
+        compiled_rules.append((tag_name, attrs))
+        if tag_name is None:
+            any_tag.append(rule_index)
+        else:
+            by_tag.setdefault(tag_name, []).append(rule_index)
+
+    return {'rules': tuple(compiled_rules),
+            'by_tag': {tag_name: tuple(rule_indexes) for tag_name, rule_indexes in by_tag.items()},
+            'any_tag': tuple(any_tag),
+            'tag_names': frozenset(by_tag) if not any_tag else None}
+
+
+def load_site_list(site_list_path):
+    with open(site_list_path, 'r') as file:
+        site_list_with_parse_logic = json.load(file)
+    for site_with_parse_logic in site_list_with_parse_logic:
+        site_with_parse_logic['compiled_rules'] = compile_rules(site_with_parse_logic['rules'])
+    return site_list_with_parse_logic
+
+
+def _attrs_match(required_attrs, attrs):
+    for attr, value in required_attrs:
+        actual_value = attrs.get(attr)
+        if actual_value is None:
+            return False
+        if actual_value == value:
+            continue
+        if attr in MULTI_VALUED_ATTRIBUTES and value in actual_value.split():
+            continue
+        return False
+    return True
+
+
+class _TitleCollector(HTMLParser):
+    # Single pass over the token stream: no tree, text is only buffered for matched elements
+
+    def __init__(self, compiled_rules):
+        super().__init__(convert_charrefs=True)
+        self.compiled_rules = compiled_rules
+        self.matches = [[] for _ in compiled_rules['rules']]
+        self.open_elements = []
+        self.active_buffers = []
+        self.non_text_depth = 0
+
+    def _match(self, tag, attrs):
+        rules = self.compiled_rules['rules']
+        candidates = self.compiled_rules['by_tag'].get(tag, ()) + self.compiled_rules['any_tag']
+        if not candidates:
+            return None
+
+        attrs = {attr: value or '' for attr, value in attrs}
+        text_buffer = None
+        for rule_index in sorted(candidates):
+            if _attrs_match(rules[rule_index][1], attrs):
+                if text_buffer is None:
+                    text_buffer = []
+                self.matches[rule_index].append(text_buffer)
+        return text_buffer
+
+    def handle_starttag(self, tag, attrs):
+        text_buffer = self._match(tag, attrs)
+        if tag in VOID_ELEMENTS:
+            return
+        self.open_elements.append((tag, text_buffer))
+        if text_buffer is not None:
+            self.active_buffers.append(text_buffer)
+        if tag in NON_TEXT_ELEMENTS:
+            self.non_text_depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self._match(tag, attrs)
+
+    def handle_endtag(self, tag):
+        for open_index in range(len(self.open_elements) - 1, -1, -1):
+            if self.open_elements[open_index][0] != tag:
+                continue
+            for open_tag, text_buffer in self.open_elements[open_index:]:
+                if text_buffer is not None:
+                    self.active_buffers.pop()
+                if open_tag in NON_TEXT_ELEMENTS:
+                    self.non_text_depth -= 1
+            del self.open_elements[open_index:]
+            return
+
+    def handle_data(self, data):
+        if self.non_text_depth:
+            return
+        for text_buffer in self.active_buffers:
+            text_buffer.append(data)
+
+    def title_texts(self):
+        return [''.join(text_buffer) for rule_matches in self.matches for text_buffer in rule_matches]
+
+
+def load_page_cache(cache_path=PAGE_CACHE_PATH):
+    try:
+        with open(cache_path, 'r') as file:
+            cached_pages = json.load(file)
+    except (OSError, ValueError):
+        cached_pages = []
+    with _page_cache_lock:
+        _page_cache.clear()
+        for url, cache_entry in cached_pages:
+            _page_cache[url] = cache_entry
+
+
+def save_page_cache(cache_path=PAGE_CACHE_PATH):
+    with _page_cache_lock:
+        cached_pages = list(_page_cache.items())
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path) or '.', prefix='.page_cache_')
+    with os.fdopen(fd, 'w') as file:
+        json.dump(cached_pages, file)
+    os.replace(tmp_path, cache_path)
+
+
+def _get_cache_entry(url):
+    with _page_cache_lock:
+        cache_entry = _page_cache.get(url)
+        if cache_entry is not None:
+            _page_cache.move_to_end(url)
+        return cache_entry
+
+
+def _put_cache_entry(url, cache_entry):
+    with _page_cache_lock:
+        _page_cache[url] = cache_entry
+        _page_cache.move_to_end(url)
+        while len(_page_cache) > PAGE_CACHE_MAX_ENTRIES:
+            _page_cache.popitem(last=False)
+
+
+def _conditional_headers(cache_entry):
+    headers = {}
+    if cache_entry is None:
+        return headers
+    if cache_entry.get('etag'):
+        headers['If-None-Match'] = cache_entry['etag']
+    if cache_entry.get('last_modified'):
+        headers['If-Modified-Since'] = cache_entry['last_modified']
+    return headers
+
+
+def fetch_page(url, cache_entry=None):
+    # Returns None when the cached copy is still current (304 or byte-identical body)
+    with stage('fetch_page', detail=url):
+        page = get_session().get(url,
+                                 headers=_conditional_headers(cache_entry),
+                                 timeout=REQUEST_TIMEOUT_SECONDS)
+        count(bytes_count=len(page.content))
+    if page.status_code == 304 and cache_entry is not None:
+        return None, cache_entry
+    page.raise_for_status()
+
+    content_hash = hashlib.sha256(page.content).hexdigest()
+    validators = {'etag': page.headers.get('ETag'),
+                  'last_modified': page.headers.get('Last-Modified'),
+                  'content_hash': content_hash}
+    if cache_entry is not None and cache_entry['content_hash'] == content_hash:
+        return None, {**cache_entry, **validators}
+    return page.content, validators
+
+
+def get_content(url, compiled_rules=None, page_content=None):
+    parse_only = None
+    if compiled_rules is not None and compiled_rules['tag_names'] is not None:
+        parse_only = SoupStrainer(list(compiled_rules['tag_names']))
+    if page_content is None:
+        page_content, _ = fetch_page(url)
+    with stage('parse_tree', detail=url) as counters:
+        counters['bytes'] = len(page_content)
+        return BeautifulSoup(page_content, TREE_PARSER, parse_only=parse_only)
 
 
 def search_title_elements(content, rules):
+    compiled_rules = rules if isinstance(rules, dict) else compile_rules(rules)
     titles = []
-    for rule in rules:
-        if rule[0] == 0:
-            titles += content.find_all(attrs=rule[1])
-        elif rule[1] == 0:
-            titles += content.find_all(rule[0])
+    for tag_name, attrs in compiled_rules['rules']:
+        if tag_name is None:
+            titles += content.find_all(attrs=dict(attrs))
+        elif not attrs:
+            titles += content.find_all(tag_name)
         else:
-            titles += content.find_all(rule[0], attrs=rule[1])
+            titles += content.find_all(tag_name, attrs=dict(attrs))
     return titles
 
 
+def stream_title_texts(page_content, compiled_rules):
+    title_collector = _TitleCollector(compiled_rules)
+    title_collector.feed(UnicodeDammit(page_content, is_html=True).unicode_markup)
+    title_collector.close()
+    return title_collector.title_texts()
+
+
 def elements_to_list(title_elements):
     title_list = []
     for title in title_elements:
-        title_list.append(title.text)
+        title_list.append(title if isinstance(title, str) else title.text)
 
     clean_list = [s.strip().replace('\n', ' ') for s in title_list]
     deduped_list = list(OrderedDict.fromkeys(clean_list))
     return deduped_list
 
 
+def _rules_key(site_with_parse_logic):
+    rules = json.dumps(site_with_parse_logic['rules'], sort_keys=True)
+    return hashlib.sha256((PARSE_MODE + rules).encode()).hexdigest()
+
+
+def scrape_site(site_with_parse_logic):
+    # Returns (title_list, changed); unchanged pages reuse the cached titles without parsing
+    url = site_with_parse_logic['link']
+    rules_key = _rules_key(site_with_parse_logic)
+    cache_entry = _get_cache_entry(url)
+    if cache_entry is not None and cache_entry.get('rules_key') != rules_key:
+        cache_entry = None
+
+    page_content, validators = fetch_page(url, cache_entry)
+    if page_content is None:
+        _put_cache_entry(url, validators)
+        return validators['title_list'], False
+
+    compiled_rules = (site_with_parse_logic.get('compiled_rules')
+                      or compile_rules(site_with_parse_logic['rules']))
+    with stage('parse_titles', detail=site_with_parse_logic['name']) as counters:
+        if PARSE_MODE == 'stream':
+            title_elements = stream_title_texts(page_content, compiled_rules)
+        else:
+            content = get_content(url, compiled_rules, page_content=page_content)
+            title_elements = search_title_elements(content, compiled_rules)
+        title_list = elements_to_list(title_elements)
+        counters['rows'] = len(title_list)
+        counters['bytes'] = len(page_content)
+
+    _put_cache_entry(url, {**validators, 'rules_key': rules_key, 'title_list': title_list})
+    return title_list, True
+
+
 def get_title_list_from_site(site_with_parse_logic):
-    content = get_content(site_with_parse_logic['link'])
-    title_elements = search_title_elements(content,
-                                           site_with_parse_logic['rules'])
-    return elements_to_list(title_elements)
+    title_list, _ = scrape_site(site_with_parse_logic)
+    return title_list
+
+
+def get_title_lists_from_sites(site_list_with_parse_logic, max_workers):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(scrape_site, site): site
+                   for site in site_list_with_parse_logic}
+        for future in as_completed(futures):
+            site = futures[future]
+            try:
+                title_list, changed = future.result()
+            except Exception:
+                logger.exception('Failed to scrape %s', site['name'])
+                continue
+            yield site, title_list, changed
@@ -1,8 +1,148 @@
-import requests
 import os
+import json
+import time
+import logging
+import fcntl
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.instrumentation import stage, count
+
+# Global constants
+HTTP_POOL_SIZE = 32
+REQUEST_TIMEOUT_SECONDS = 30
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RATE_LIMIT_RESERVE = 1
+PAGE_SIZE = 100
+REDDIT_AUTH_URL = os.environ.get('PG_REDDIT_AUTH_URL', 'https://www.reddit.com/api/v1/access_token')
+REDDIT_API_URL = os.environ.get('PG_REDDIT_API_URL', 'https://oauth.reddit.com')
+TOKEN_CACHE_PATH = os.environ.get('PG_REDDIT_TOKEN_CACHE',
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                               '.reddit_token_cache.json'))
+TOKEN_EXPIRY_MARGIN_SECONDS = 300
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+_rate_limit_lock = threading.Lock()
+_rate_limit = {'remaining': None, 'reset_at': 0.0}
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2,
+                                  pool_maxsize=HTTP_POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+    return _session
+
+
+def _wait_for_rate_limit():
+    with _rate_limit_lock:
+        remaining = _rate_limit['remaining']
+        if remaining is not None and remaining <= RATE_LIMIT_RESERVE:
+            wait_seconds = _rate_limit['reset_at'] - time.monotonic()
+            if wait_seconds > 0:
+                time.sleep(wait_seconds)
+            _rate_limit['remaining'] = None
+        elif remaining is not None:
+            _rate_limit['remaining'] = remaining - 1
+
+
+def _update_rate_limit(headers):
+    remaining = headers.get('X-Ratelimit-Remaining')
+    reset = headers.get('X-Ratelimit-Reset')
+    if remaining is None or reset is None:
+        return
+    with _rate_limit_lock:
+        _rate_limit['remaining'] = float(remaining)
+        _rate_limit['reset_at'] = time.monotonic() + float(reset)
+
+
+def _backoff_seconds(res, attempt):
+    retry_after = res.headers.get('Retry-After')
+    if retry_after is not None and retry_after.isdigit():
+        return int(retry_after)
+    return BACKOFF_BASE_SECONDS * 2 ** attempt
+
+
+def _get_with_retries(url, headers, params):
+    session = get_session()
+    refreshed_token = False
+    for attempt in range(MAX_RETRIES):
+        _wait_for_rate_limit()
+        res = session.get(url,
+                          headers=headers,
+                          params=params,
+                          timeout=REQUEST_TIMEOUT_SECONDS)
+        count(bytes_count=len(res.content))
+        _update_rate_limit(res.headers)
+        if res.status_code == 401 and not refreshed_token and 'Authorization' in headers:
+            # Updates the caller's headers, so later pages reuse the refreshed token
+            stale_token = headers['Authorization'].split(' ', 1)[1]
+            headers['Authorization'] = f'bearer {api_auth(stale_token=stale_token)}'
+            refreshed_token = True
+            continue
+        if res.status_code not in RETRY_STATUS_CODES:
+            break
+        if attempt < MAX_RETRIES - 1:
+            time.sleep(_backoff_seconds(res, attempt))
+    res.raise_for_status()
+    return res
+
+
+@contextmanager
+def _token_cache_lock():
+    # flock serialises token refreshes across threads and concurrent extract processes
+    with open(TOKEN_CACHE_PATH + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _token_cache_key():
+    credentials = os.environ['PG_REDDIT_CLIENT_ID'] + ':' + os.environ['PG_REDDIT_USERNAME']
+    return hashlib.sha256(credentials.encode()).hexdigest()
 
 
-def api_auth():
+def _read_cached_token():
+    try:
+        with open(TOKEN_CACHE_PATH, 'r') as file:
+            cached_token = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if cached_token.get('key') != _token_cache_key():
+        return None
+    return cached_token
+
+
+def _write_cached_token(access_token, expires_at):
+    cache_dir = os.path.dirname(TOKEN_CACHE_PATH) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.reddit_token_')
+    with os.fdopen(fd, 'w') as file:
+        json.dump({'key': _token_cache_key(),
+                   'access_token': access_token,
+                   'expires_at': expires_at}, file)
+    os.replace(tmp_path, TOKEN_CACHE_PATH)
+
+
+def _request_token():
 
     data = {'grant_type': os.environ['PG_REDDIT_GRANT_TYPE'],
             'username': os.environ['PG_REDDIT_USERNAME'],
@@ -12,21 +152,111 @@ def api_auth():
         os.environ['PG_REDDIT_SECRET_TOKEN'])
     headers = {'User-Agent': os.environ['PG_REDDIT_USER_AGENT']}
 
-    res = requests.post('https://www.reddit.com/api/v1/access_token',
-                        auth=auth, data=data, headers=headers)
-    TOKEN = res.json()['access_token']
+    res = get_session().post(REDDIT_AUTH_URL,
+                             auth=auth, data=data, headers=headers,
+                             timeout=REQUEST_TIMEOUT_SECONDS)
+    res.raise_for_status()
+    token_response = res.json()
+    return token_response['access_token'], time.time() + token_response.get('expires_in', 0)
+
+
+def api_auth(stale_token=None):
+    # stale_token is the token a request was just rejected with; any other unexpired cached token is reused
+    with _token_cache_lock():
+        cached_token = _read_cached_token()
+        if (cached_token is not None
+                and cached_token['access_token'] != stale_token
+                and cached_token['expires_at'] - TOKEN_EXPIRY_MARGIN_SECONDS > time.time()):
+            return cached_token['access_token']
+
+        TOKEN, expires_at = _request_token()
+        _write_cached_token(TOKEN, expires_at)
     return TOKEN
 
 
-def fetch_posts(subreddit, post_count, TOKEN):
+def _is_seen(post_data, seen_cursor):
+    if seen_cursor is None:
+        return False
+    seen_name, seen_created_utc = seen_cursor
+    return (post_data.get('name') == seen_name
+            or post_data.get('created_utc', 0) <= seen_created_utc)
+
 
-    post_count = min(100, post_count)
+def iter_posts(subreddit, TOKEN, min_posts, max_posts, seen_cursor=None):
+    # Newest first, page by page: always the first min_posts (the hourly snapshot),
+    # then keep paging until reaching a post captured by the previous run or max_posts
     headers = {'User-Agent': os.environ['PG_REDDIT_USER_AGENT'],
                **{'Authorization': f'bearer {TOKEN}'}}
-    params = {'limit': post_count}
-    url = 'https://oauth.reddit.com/r/' + subreddit + '/new'
+    url = REDDIT_API_URL + '/r/' + subreddit + '/new'
+    after = None
+    yielded = 0
+    reached_seen = False
+
+    while yielded < max_posts:
+        params = {'limit': min(PAGE_SIZE, max_posts - yielded)}
+        if after is not None:
+            params['after'] = after
+
+        res = _get_with_retries(url,
+                                headers=headers,
+                                params=params)
+        listing = res.json()['data']
+
+        for post in listing['children']:
+            reached_seen = reached_seen or _is_seen(post['data'], seen_cursor)
+            if reached_seen and yielded >= min_posts:
+                return
+            yield post
+            yielded += 1
+
+        # The cursor can turn up inside the snapshot's own pages; once both are covered, stop before the next request
+        if reached_seen and yielded >= min_posts:
+            return
+        after = listing.get('after')
+        if after is None or not listing['children']:
+            return
+
+
+def fetch_posts(subreddit, post_count, TOKEN):
+    with stage('fetch_posts', detail=subreddit) as counters:
+        post_list = list(iter_posts(subreddit, TOKEN, min_posts=post_count, max_posts=post_count))
+        counters['rows'] = len(post_list)
+    return post_list
+
+
+def _list_posts(posts, snapshot_time):
+    return list(posts)
+
+
+def _fetch_rows(subreddit, TOKEN, min_posts, max_posts, seen_cursor, row_builder):
+    with stage('fetch_posts', detail=subreddit) as counters:
+        posts = iter_posts(subreddit, TOKEN, min_posts, max_posts, seen_cursor)
+        first_post = next(posts, None)
+        snapshot_time = datetime.now()
+        rows = row_builder(chain([first_post], posts), snapshot_time) if first_post is not None else []
+        counters['rows'] = len(rows)
+    return rows, snapshot_time
+
 
-    res = requests.get(url,
-                       headers=headers,
-                       params=params)
-    return res.json()['data']['children']
+def fetch_posts_concurrently(subreddit_list, post_count, TOKEN, max_workers,
+                             max_post_count=None, seen_cursors=None, row_builder=_list_posts):
+    # Workers consume the page generator straight into row_builder, so only its compact rows are kept
+    seen_cursors = seen_cursors or {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_fetch_rows,
+                                   subreddit=subreddit,
+                                   TOKEN=TOKEN,
+                                   min_posts=post_count,
+                                   max_posts=max_post_count or post_count,
+                                   seen_cursor=seen_cursors.get(subreddit),
+                                   row_builder=row_builder): subreddit
+                   for subreddit in subreddit_list}
+        for future in as_completed(futures):
+            subreddit = futures[future]
+            try:
+                rows, snapshot_time = future.result()
+            except Exception:
+                # A private, banned or failing subreddit must not cost the rest of the hour's capture
+                logger.exception('Failed to fetch posts from r/%s', subreddit)
+                continue
+            yield subreddit, rows, snapshot_time
@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+import fcntl
+import signal
+import logging
+import threading
+from datetime import datetime, timedelta
+
+REPO_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [REPO_PATH, os.path.join(REPO_PATH, 'extract'), os.path.join(REPO_PATH, 'transform')]
+
+import extract_reddit_posts
+import extract_news_titles
+import fct_reddit_snapshots_hourly
+import agg_subreddit_metrics_hourly
+from news_sites_extract_modules.title_list_scraper import load_site_list
+from common.db_operations import close_pool
+from common.instrumentation import start_run, end_run, stage
+
+# Global constants
+TICK_MINUTE = 8  # Minute past every hour, same slot as the old crontab entry
+LOCK_PATH = os.environ.get('PG_ORCHESTRATOR_LOCK', os.path.join(REPO_PATH, '.orchestrator.lock'))
+
+logger = logging.getLogger('orchestrator')
+
+_stop = threading.Event()
+
+
+def next_tick_time(now):
+    tick_time = now.replace(minute=TICK_MINUTE, second=0, microsecond=0)
+    if tick_time <= now:
+        tick_time += timedelta(hours=1)
+    return tick_time
+
+
+def _run_step(step_name, step_function, *args):
+    with stage('pipeline', detail=step_name):
+        started = time.monotonic()
+        try:
+            step_function(*args)
+        except Exception:
+            logger.exception('%s failed', step_name)
+            return False
+    logger.info('%s finished in %.1fs', step_name, time.monotonic() - started)
+    return True
+
+
+def run_reddit_branch(is_test):
+    # Each transform starts as soon as the step it reads from has committed
+    if not _run_step('extract_reddit_posts', extract_reddit_posts.pipeline, is_test):
+        return
+    if not _run_step('fct_reddit_snapshots_hourly', fct_reddit_snapshots_hourly.pipeline, is_test):
+        return
+    _run_step('agg_subreddit_metrics_hourly', agg_subreddit_metrics_hourly.pipeline, is_test)
+
+
+def run_news_branch(is_test, site_list_with_parse_logic):
+    _run_step('extract_news_titles', extract_news_titles.pipeline, is_test, site_list_with_parse_logic)
+
+
+def run_tick(is_test, site_list_with_parse_logic):
+    # The news scrape shares nothing with the reddit DAG, so it runs alongside it
+    with open(LOCK_PATH, 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.warning('Previous run still holds %s, skipping this tick', LOCK_PATH)
+            return
+
+        start_run('orchestrator')
+        try:
+            news_thread = threading.Thread(target=run_news_branch,
+                                           args=(is_test, site_list_with_parse_logic),
+                                           name='news')
+            news_thread.start()
+            run_reddit_branch(is_test)
+            news_thread.join()
+        finally:
+            end_run()
+
+
+def serve(is_test, run_once=False):
+    site_list_with_parse_logic = load_site_list(extract_news_titles.SITE_LIST_PARSE_LOGIC_FILE)
+    if is_test: site_list_with_parse_logic = site_list_with_parse_logic[:1]
+
+    while not _stop.is_set():
+        if not run_once:
+            tick_time = next_tick_time(datetime.now())
+            logger.info('Next run at %s', tick_time.isoformat(sep=' '))
+            if _stop.wait((tick_time - datetime.now()).total_seconds()):
+                return
+        run_tick(is_test, site_list_with_parse_logic)
+        if run_once:
+            return
+
+
+def _handle_stop_signal(signum, frame):
+    logger.info('Received signal %s, stopping after the current run', signum)
+    _stop.set()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(levelname)s %(message)s')
+    signal.signal(signal.SIGTERM, _handle_stop_signal)
+    signal.signal(signal.SIGINT, _handle_stop_signal)
+
+    is_test = any(test_flag in sys.argv for test_flag in ['test', '--test'])
+    run_once = any(once_flag in sys.argv for once_flag in ['once', '--once'])
+    try:
+        serve(is_test, run_once)
+    finally:
+        close_pool()
@@ -0,0 +1,34 @@
+#!/bin/bash
+
+set -o xtrace
+
+cd "$(dirname "$0")"
+
+FLAGS=""
+for arg in "$@"; do
+    if [ "$arg" == "--test" ] || [ "$arg" == "test" ]; then FLAGS="$FLAGS --test"; fi
+done
+
+DOCKER_CMD="export PYTHONPATH=/home/ && exec python ./orchestrate.py $FLAGS"
+
+docker rm -f playground-orchestrator
+
+docker run -d \
+    --restart unless-stopped \
+    -e PG_DB_HOST=$PG_DB_HOST \
+    -e PG_DB_PORT=$PG_DB_PORT \
+    -e PG_DB_NAME=$PG_DB_NAME \
+    -e PG_DB_USER=$PG_DB_USER \
+    -e PG_DB_PASSWORD=$PG_DB_PASSWORD \
+    -e PG_EXPLAIN_SAMPLE_RATE=$PG_EXPLAIN_SAMPLE_RATE \
+    -e PG_METRICS_LOG=$PG_METRICS_LOG \
+    -e PG_REDDIT_GRANT_TYPE=$PG_REDDIT_GRANT_TYPE \
+    -e PG_REDDIT_USERNAME=$PG_REDDIT_USERNAME \
+    -e PG_REDDIT_PASSWORD=$PG_REDDIT_PASSWORD \
+    -e PG_REDDIT_CLIENT_ID=$PG_REDDIT_CLIENT_ID \
+    -e PG_REDDIT_SECRET_TOKEN=$PG_REDDIT_SECRET_TOKEN \
+    -e PG_REDDIT_USER_AGENT=$PG_REDDIT_USER_AGENT \
+    --name playground-orchestrator \
+    -v $PWD:/home/ \
+    benkl/playground \
+    /bin/bash -c "$DOCKER_CMD"
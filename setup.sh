@@ -4,4 +4,7 @@ set -o xtrace
 
 docker build -t benkl/playground .
 
-(crontab -l ; echo "8 * * * * . $HOME/.profile; ${PWD}/extract.sh") | crontab -
+# The orchestrator container schedules extract -> transform itself; drop the old hourly cron entry
+crontab -l | grep -v "${PWD}/extract.sh" | crontab -
+
+. $HOME/.profile; ${PWD}/orchestrate.sh
@@ -4,11 +4,17 @@ set -o xtrace
 
 cd "$(dirname "$0")"
 
-if [ "$1" == "--test" ] || [ "$1" == "test" ]; then 
-    DOCKER_CMD="export PYTHONPATH=/home/ && python ./transform/fct_reddit_snapshots_hourly.py --test && python ./transform/agg_subreddit_metrics_hourly.py --test"
-else
-    DOCKER_CMD="export PYTHONPATH=/home/ && python ./transform/fct_reddit_snapshots_hourly.py && python ./transform/agg_subreddit_metrics_hourly.py"
-fi
+FLAGS=""
+FCT_FLAGS=""
+for arg in "$@"; do
+    if [ "$arg" == "--test" ] || [ "$arg" == "test" ]; then FLAGS="$FLAGS --test"; fi
+    if [ "$arg" == "--profile" ] || [ "$arg" == "profile" ]; then FLAGS="$FLAGS --profile"; fi
+    if [ "$arg" == "--reconcile" ] || [ "$arg" == "reconcile" ]; then FLAGS="$FLAGS --reconcile"; fi
+    if [ "$arg" == "--compact" ] || [ "$arg" == "compact" ]; then FCT_FLAGS="$FCT_FLAGS --compact"; fi
+    if [ "$arg" == "--drop-legacy" ] || [ "$arg" == "drop-legacy" ]; then FCT_FLAGS="$FCT_FLAGS --drop-legacy"; fi
+done
+
+DOCKER_CMD="export PYTHONPATH=/home/ && python ./transform/fct_reddit_snapshots_hourly.py $FLAGS $FCT_FLAGS && python ./transform/agg_subreddit_metrics_hourly.py $FLAGS"
 
 docker run --rm \
     -e PG_DB_HOST=$PG_DB_HOST \
@@ -16,6 +22,8 @@ docker run --rm \
     -e PG_DB_NAME=$PG_DB_NAME \
     -e PG_DB_USER=$PG_DB_USER \
     -e PG_DB_PASSWORD=$PG_DB_PASSWORD \
+    -e PG_EXPLAIN_SAMPLE_RATE=$PG_EXPLAIN_SAMPLE_RATE \
+    -e PG_METRICS_LOG=$PG_METRICS_LOG \
     -e PG_REDDIT_GRANT_TYPE=$PG_REDDIT_GRANT_TYPE \
     -e PG_REDDIT_USERNAME=$PG_REDDIT_USERNAME \
     -e PG_REDDIT_PASSWORD=$PG_REDDIT_PASSWORD \
@@ -1,12 +1,23 @@
 import sys
 from datetime import datetime
 
-from common.db_operations import execute_sql, create_partition, get_missing_date_hours
+from common.instrumentation import run_pipeline
+from common.db_operations import (execute_sql, create_partition, get_date_hours_to_process, transaction, close_pool,
+                                  chunk_date_hours, date_hours_values_sql, record_watermarks,
+                                  get_unprocessed_date_hours, shard_date_hours_by_day, run_sharded,
+                                  delete_date_hours)
+from common.schema_management import maintain_table, convert_to_partitioned, table_exists
+from common.compact_storage import is_compact, ids_view_name, get_subreddit_ids
+from transform.rollup_subreddit_metrics import prepare_rollups, update_rollups
 
 
 # Global constants
 SOURCE_TABLE_NAME_BASE = 'fct_reddit_snapshots_hourly'
+UPSTREAM_TABLE_NAME_BASE = 'reddit_data'  # Feeds the source table; its pending hours gate this step
+LATEST_STATE_TABLE_NAME_BASE = 'fct_reddit_posts_latest'  # Maintained by the fct step
 TARGET_TABLE_NAME_BASE = 'agg_subreddit_metrics_hourly'
+TARGET_PARTITION_PREFIX_BASE = 'asmh_'
+PARTITION_RETENTION_DAYS = None  # None keeps every partition
 
 SOURCE_DATE_FIELD = 'snapshotted_on'
 SOURCE_HOUR_FIELD = 'snapshotted_hour'
@@ -14,6 +25,9 @@ TARGET_DATE_FIELD = 'snapshotted_on'
 TARGET_HOUR_FIELD = 'snapshotted_hour'
 AGG_BACKFILL_LOOKBACK_DAYS = 28
 AGG_SELF_JOIN_LOOKBACK_DAYS = 2
+AGG_ENGINE = 'latest_state'  # 'latest_state' (newest hour from the latest-state table, lag otherwise), 'lag' or 'self_join'
+AGG_BATCH_SIZE_HOURS = 168
+AGG_WORKERS = 4  # Above 1, the lag engine runs one shard per (day, subreddit)
 
 
 def create_table(table_name):
@@ -27,7 +41,8 @@ def create_table(table_name):
             downvotes INTEGER,
             comments INTEGER,
             awards INTEGER
-        );
+        )
+        PARTITION BY RANGE (snapshotted_on);
     """
     execute_sql(sql=create_sql)
 
@@ -107,27 +122,402 @@ def aggregate_reddit_data(source_table_name,
     execute_sql(sql=transform_sql)
 
 
-def pipeline(is_test):
+def aggregate_reddit_data_lag(source_table_name,
+                              target_table_name,
+                              date_hours,
+                              subreddit=None,
+                              subreddit_id=None):
+    # Ranks are per subreddit and every post belongs to one, so a subreddit filter yields the same rows.
+    # On the compact ids view the id filter hits the compact table's index without going through the dim join
+    subreddit_filter = ''
+    if subreddit_id is not None:
+        subreddit_filter = f"and subreddit_id = {int(subreddit_id)}"
+    elif subreddit is not None:
+        subreddit_filter = f"and subreddit = '{subreddit}'"
+    min_snapshotted_on = min(date_hour[0] for date_hour in date_hours)
+    max_snapshotted_on = max(date_hour[0] for date_hour in date_hours)
+    transform_sql = f"""
+        insert into {target_table_name}(subreddit,
+                                        snapshotted_on,
+                                        snapshotted_hour,
+                                        overlapping_posts_between_snapshots,
+                                        upvotes,
+                                        downvotes,
+                                        comments,
+                                        awards)
+        with missing_date_hours(snapshotted_on, snapshotted_hour) as (
+            values
+            {date_hours_values_sql(date_hours)}
+        ),
+
+        fct_reddit_post_snapshots_hourly_ranked as (
+            select
+                *,
+                dense_rank() over(partition by subreddit
+                    order by snapshotted_on, snapshotted_hour)
+                    as date_hour_rank
+            from 
+                {source_table_name}
+            where 
+                snapshotted_on BETWEEN '{min_snapshotted_on}'::DATE - {AGG_SELF_JOIN_LOOKBACK_DAYS} AND '{max_snapshotted_on}'
+            {subreddit_filter}
+        ),
+
+        fct_reddit_post_snapshots_hourly_with_previous as (
+            select
+                subreddit,
+                snapshotted_on,
+                snapshotted_hour,
+                date_hour_rank,
+                upvote_count,
+                downvote_count,
+                comment_count,
+                award_count,
+                lag(date_hour_rank) over post_snapshots as previous_date_hour_rank,
+                lag(snapshotted_on) over post_snapshots as previous_snapshotted_on,
+                lag(upvote_count) over post_snapshots as previous_upvote_count,
+                lag(downvote_count) over post_snapshots as previous_downvote_count,
+                lag(comment_count) over post_snapshots as previous_comment_count,
+                lag(award_count) over post_snapshots as previous_award_count
+            from
+                fct_reddit_post_snapshots_hourly_ranked
+            window post_snapshots as (partition by post_id
+                                      order by snapshotted_on, snapshotted_hour)
+        ),
+
+        reddit_metric_diffs_from_consecutive_snapshots as (
+            select
+                current_snapshot.subreddit,
+                current_snapshot.snapshotted_on,
+                current_snapshot.snapshotted_hour,
+                current_snapshot.upvote_count
+                    - current_snapshot.previous_upvote_count
+                        as new_upvotes,
+                current_snapshot.downvote_count
+                    - current_snapshot.previous_downvote_count
+                        as new_downvotes,
+                current_snapshot.comment_count
+                    - current_snapshot.previous_comment_count
+                        as new_comments,
+                current_snapshot.award_count
+                    - current_snapshot.previous_award_count
+                        as new_awards
+            from
+                fct_reddit_post_snapshots_hourly_with_previous as current_snapshot
+                inner join missing_date_hours
+                on current_snapshot.snapshotted_on = missing_date_hours.snapshotted_on
+                and current_snapshot.snapshotted_hour = missing_date_hours.snapshotted_hour
+            where  -- same pairing as the self join: the subreddit's previous snapshot, inside the lookback
+                current_snapshot.previous_date_hour_rank = current_snapshot.date_hour_rank - 1
+            and
+                current_snapshot.previous_snapshotted_on >= current_snapshot.snapshotted_on - {AGG_SELF_JOIN_LOOKBACK_DAYS}
+        )
+
+        select
+            subreddit,
+            snapshotted_on,
+            snapshotted_hour,
+            count(1) as overlapping_posts_between_snapshots,
+            sum(new_upvotes) as new_upvotes,
+            sum(new_downvotes) as new_downvotes,
+            sum(new_comments) as new_comments,
+            sum(new_awards) as new_awards
+        from 
+            reddit_metric_diffs_from_consecutive_snapshots
+        group by 1, 2, 3
+        order by 1, 2, 3
+    """
+    execute_sql(sql=transform_sql)
+
+
+def aggregate_reddit_data_latest_state(source_table_name,
+                                      latest_table_name,
+                                      target_table_name,
+                                      snapshotted_on,
+                                      snapshotted_hour,
+                                      subreddit_ids=None):
+    # Only valid for the newest merged hour: every post seen then carries that snapshot as current
+    # and its previous one as prev_*, so the deltas touch just this hour's posts.
+    # subreddit_ids (name -> id, compact fct only) lets the lookup below match on the indexed id
+    if subreddit_ids:
+        current_subreddits_sql = f"""
+            select
+                subreddit,
+                subreddit_id
+            from (values
+                {', '.join(f"('{subreddit}', {int(subreddit_id)})" for subreddit, subreddit_id in sorted(subreddit_ids.items()))}
+            ) as subreddits(subreddit, subreddit_id)"""
+        previous_snapshot_filter = 'fct.subreddit_id = current_subreddits.subreddit_id'
+    else:
+        current_subreddits_sql = f"""
+            select distinct
+                subreddit
+            from
+                {latest_table_name}
+            where
+                snapshotted_on = '{snapshotted_on}'
+            and
+                snapshotted_hour = {snapshotted_hour}"""
+        previous_snapshot_filter = 'fct.subreddit = current_subreddits.subreddit'
+    transform_sql = f"""
+        insert into {target_table_name}(subreddit,
+                                        snapshotted_on,
+                                        snapshotted_hour,
+                                        overlapping_posts_between_snapshots,
+                                        upvotes,
+                                        downvotes,
+                                        comments,
+                                        awards)
+        with current_subreddits as ({current_subreddits_sql}
+        ),
+
+        previous_subreddit_snapshots as (  -- same pairing as the self join: the subreddit's previous snapshot
+            select
+                current_subreddits.subreddit,
+                previous_snapshot.snapshotted_on,
+                previous_snapshot.snapshotted_hour
+            from
+                current_subreddits
+                cross join lateral (
+                    select
+                        snapshotted_on,
+                        snapshotted_hour
+                    from
+                        {source_table_name} as fct
+                    where
+                        {previous_snapshot_filter}
+                    and
+                        fct.snapshotted_on >= '{snapshotted_on}'::DATE - {AGG_SELF_JOIN_LOOKBACK_DAYS}
+                    and
+                        (fct.snapshotted_on, fct.snapshotted_hour) < ('{snapshotted_on}'::DATE, {snapshotted_hour})
+                    order by
+                        fct.snapshotted_on desc, fct.snapshotted_hour desc
+                    limit 1
+                ) as previous_snapshot
+        )
+
+        select
+            latest.subreddit,
+            latest.snapshotted_on,
+            latest.snapshotted_hour,
+            count(1) as overlapping_posts_between_snapshots,
+            sum(latest.upvote_count - latest.prev_upvote_count) as new_upvotes,
+            sum(latest.downvote_count - latest.prev_downvote_count) as new_downvotes,
+            sum(latest.comment_count - latest.prev_comment_count) as new_comments,
+            sum(latest.award_count - latest.prev_award_count) as new_awards
+        from
+            {latest_table_name} as latest
+            inner join previous_subreddit_snapshots as previous
+            on latest.subreddit = previous.subreddit
+            and latest.prev_snapshotted_on = previous.snapshotted_on
+            and latest.prev_snapshotted_hour = previous.snapshotted_hour
+        where
+            latest.snapshotted_on = '{snapshotted_on}'
+        and
+            latest.snapshotted_hour = {snapshotted_hour}
+        group by 1, 2, 3
+        order by 1, 2, 3
+    """
+    execute_sql(sql=transform_sql)
+
+
+def split_latest_state_hours(source_table_name, latest_table_name, missing_date_hours):
+    # The latest-state table can answer only the newest hour, and only once every fct hour is merged into it
+    if not missing_date_hours or not table_exists(latest_table_name):
+        return missing_date_hours, []
+    if get_unprocessed_date_hours(source_table_name=source_table_name,
+                                  target_table_name=latest_table_name,
+                                  lookback_days=AGG_BACKFILL_LOOKBACK_DAYS):
+        return missing_date_hours, []
+    newest_merged = execute_sql(sql=f"""
+        select snapshotted_on::VARCHAR, snapshotted_hour
+        from {latest_table_name}
+        order by snapshotted_on desc, snapshotted_hour desc
+        limit 1;
+    """)
+    newest_missing = missing_date_hours[-1]
+    if not newest_merged or tuple(newest_merged[0]) != (newest_missing[0], newest_missing[1]):
+        return missing_date_hours, []
+    return missing_date_hours[:-1], [newest_missing]
+
+
+def get_latest_state_subreddits(latest_table_name, snapshotted_on, snapshotted_hour):
+    subreddits_sql = f"""
+        select distinct subreddit
+        from {latest_table_name}
+        where snapshotted_on = '{snapshotted_on}'
+        and snapshotted_hour = {snapshotted_hour};
+    """
+    return [subreddit for (subreddit,) in execute_sql(sql=subreddits_sql)]
+
+
+def complete_date_hours(target_table_name, date_hours):
+    # Marks the hours as done and folds them into the daily/weekly rollups in one step
+    with transaction():
+        record_watermarks(target_table_name, date_hours)
+        update_rollups(target_table_name, date_hours)
+
+
+def get_subreddits_by_day(source_table_name, snapshot_dates):
+    subreddits_sql = f"""
+        select distinct
+            snapshotted_on::VARCHAR,
+            subreddit
+        from {source_table_name}
+        where snapshotted_on in ({', '.join(f"'{snapshot_date}'" for snapshot_date in snapshot_dates)})
+        order by 1, 2;
+    """
+    subreddits_by_day = {}
+    for snapshotted_on, subreddit in execute_sql(sql=subreddits_sql):
+        subreddits_by_day.setdefault(snapshotted_on, []).append(subreddit)
+    return subreddits_by_day
+
+
+def aggregate_subreddit_shard(source_table_name, target_table_name, date_hours, subreddit, subreddit_id=None):
+    # The table has no key, so a shard clears its own rows first and stays safe to rerun
+    delete_sql = f"""
+        delete from {target_table_name}
+        where subreddit = '{subreddit}'
+        and snapshotted_on = '{date_hours[0][0]}'
+        and snapshotted_hour in ({', '.join(str(int(date_hour[1])) for date_hour in date_hours)});
+    """
+    execute_sql(sql=delete_sql)
+    aggregate_reddit_data_lag(source_table_name,
+                              target_table_name,
+                              date_hours=date_hours,
+                              subreddit=subreddit,
+                              subreddit_id=subreddit_id)
+
+
+def aggregate_in_parallel(source_table_name, target_table_name, missing_date_hours, by_subreddit_id=False):
+    # A day's watermarks are recorded only once all of its subreddit shards have committed
+    if not missing_date_hours:
+        return
+    day_shards = shard_date_hours_by_day(missing_date_hours)
+    subreddits_by_day = get_subreddits_by_day(source_table_name, day_shards)
+    subreddit_ids = {}
+    if by_subreddit_id:
+        # Resolved once for every shard
+        subreddit_ids = get_subreddit_ids(subreddit for subreddits in subreddits_by_day.values()
+                                          for subreddit in subreddits)
+    pending_shards = {snapshotted_on: len(subreddits_by_day.get(snapshotted_on, []))
+                      for snapshotted_on in day_shards}
+    for snapshotted_on, shard_count in pending_shards.items():
+        if shard_count == 0:
+            complete_date_hours(target_table_name, day_shards[snapshotted_on])
+
+    shards = [(source_table_name, target_table_name, day_shards[snapshotted_on], subreddit,
+               subreddit_ids.get(subreddit))
+              for snapshotted_on in day_shards
+              for subreddit in subreddits_by_day.get(snapshotted_on, [])]
+    errors = []
+    for (_, _, date_hours, _, _), error in run_sharded(aggregate_subreddit_shard, shards, AGG_WORKERS):
+        snapshotted_on = date_hours[0][0]
+        if error is not None:
+            errors.append(error)
+            pending_shards[snapshotted_on] = None
+            continue
+        if pending_shards[snapshotted_on] is None:
+            continue
+        pending_shards[snapshotted_on] -= 1
+        if pending_shards[snapshotted_on] == 0:
+            complete_date_hours(target_table_name, date_hours)
+    if errors:
+        raise errors[0]
+
+
+def hours_before_upstream_gap(upstream_table_name, source_table_name, missing_date_hours):
+    # An hour is only aggregated once every earlier hour has reached the source table,
+    # otherwise its posts would be paired with an older snapshot than the previous one
+    upstream_pending = get_unprocessed_date_hours(source_table_name=upstream_table_name,
+                                                  target_table_name=source_table_name,
+                                                  lookback_days=AGG_BACKFILL_LOOKBACK_DAYS)
+    if not upstream_pending:
+        return missing_date_hours
+    first_pending = (upstream_pending[0][0], upstream_pending[0][1])
+    return [date_hour for date_hour in missing_date_hours
+            if (date_hour[0], date_hour[1]) < first_pending]
+
+
+def pipeline(is_test, full_reconcile=False):
     source_table_name = SOURCE_TABLE_NAME_BASE if not is_test else 'test_' + SOURCE_TABLE_NAME_BASE
     target_table_name = TARGET_TABLE_NAME_BASE if not is_test else 'test_' + TARGET_TABLE_NAME_BASE
+    upstream_table_name = UPSTREAM_TABLE_NAME_BASE if not is_test else 'test_' + UPSTREAM_TABLE_NAME_BASE
+    latest_table_name = LATEST_STATE_TABLE_NAME_BASE if not is_test else 'test_' + LATEST_STATE_TABLE_NAME_BASE
 
+    target_partition_prefix = TARGET_PARTITION_PREFIX_BASE if not is_test else 'test_' + TARGET_PARTITION_PREFIX_BASE
+
+    convert_to_partitioned(target_table_name, target_partition_prefix, TARGET_DATE_FIELD, create_table)
     create_table(target_table_name)
+    maintain_table(target_table_name, target_partition_prefix, retention_days=PARTITION_RETENTION_DAYS)
+    prepare_rollups(target_table_name, full_rebuild=full_reconcile)
 
-    missing_date_hours = get_missing_date_hours(source_table_name=source_table_name,
-                                                source_date_field=SOURCE_DATE_FIELD,
-                                                source_hour_field=SOURCE_HOUR_FIELD,
-                                                target_table_name=target_table_name, 
-                                                target_date_field=TARGET_DATE_FIELD, 
-                                                target_hour_field=TARGET_HOUR_FIELD, 
-                                                lookback_days=AGG_BACKFILL_LOOKBACK_DAYS)
+    missing_date_hours = get_date_hours_to_process(source_table_name=source_table_name,
+                                                   source_date_field=SOURCE_DATE_FIELD,
+                                                   source_hour_field=SOURCE_HOUR_FIELD,
+                                                   target_table_name=target_table_name,
+                                                   target_date_field=TARGET_DATE_FIELD,
+                                                   target_hour_field=TARGET_HOUR_FIELD,
+                                                   lookback_days=AGG_BACKFILL_LOOKBACK_DAYS,
+                                                   full_reconcile=full_reconcile)
+    missing_date_hours = hours_before_upstream_gap(upstream_table_name, source_table_name, missing_date_hours)
 
-    for date_hour in missing_date_hours:
-        aggregate_reddit_data(source_table_name, 
-                              target_table_name,
-                              snapshotted_on=date_hour[0], 
-                              snapshotted_hour=date_hour[1])
+    with transaction():
+        for missing_date_partition in set([date_hour[0] for date_hour in missing_date_hours]):
+            create_partition(target_table_name, target_partition_prefix, date_stamp=missing_date_partition)
+
+    # Gap detection above runs on the logical fct name, the aggregations join the bigint-keyed view if fct is compact
+    compact = is_compact(source_table_name)
+    source_relation = ids_view_name(source_table_name) if compact else source_table_name
+
+    latest_state_date_hours = []
+    if AGG_ENGINE == 'latest_state':
+        missing_date_hours, latest_state_date_hours = split_latest_state_hours(source_table_name,
+                                                                               latest_table_name,
+                                                                               missing_date_hours)
+
+    if AGG_ENGINE in ('lag', 'latest_state') and AGG_WORKERS > 1:
+        aggregate_in_parallel(source_relation, target_table_name, missing_date_hours, by_subreddit_id=compact)
+    elif AGG_ENGINE in ('lag', 'latest_state'):
+        for date_hours in chunk_date_hours(missing_date_hours, AGG_BATCH_SIZE_HOURS):
+            with transaction():
+                delete_date_hours(target_table_name, TARGET_DATE_FIELD, TARGET_HOUR_FIELD, date_hours)
+                aggregate_reddit_data_lag(source_relation,
+                                          target_table_name,
+                                          date_hours=date_hours)
+                complete_date_hours(target_table_name, date_hours)
+    else:
+        for date_hour in missing_date_hours:
+            with transaction():
+                delete_date_hours(target_table_name, TARGET_DATE_FIELD, TARGET_HOUR_FIELD, [date_hour])
+                aggregate_reddit_data(source_relation, 
+                                      target_table_name,
+                                      snapshotted_on=date_hour[0], 
+                                      snapshotted_hour=date_hour[1])
+                complete_date_hours(target_table_name, [date_hour])
+
+    for date_hour in latest_state_date_hours:
+        subreddit_ids = None
+        if compact:
+            subreddit_ids = get_subreddit_ids(get_latest_state_subreddits(latest_table_name,
+                                                                          snapshotted_on=date_hour[0],
+                                                                          snapshotted_hour=date_hour[1]))
+        with transaction():
+            delete_date_hours(target_table_name, TARGET_DATE_FIELD, TARGET_HOUR_FIELD, [date_hour])
+            aggregate_reddit_data_latest_state(source_relation,
+                                               latest_table_name,
+                                               target_table_name,
+                                               snapshotted_on=date_hour[0],
+                                               snapshotted_hour=date_hour[1],
+                                               subreddit_ids=subreddit_ids)
+            complete_date_hours(target_table_name, [date_hour])
 
 
 if __name__ == '__main__':
     is_test = any(test_flag in sys.argv for test_flag in ['test', '--test'])
-    pipeline(is_test)
\ No newline at end of file
+    full_reconcile = any(reconcile_flag in sys.argv for reconcile_flag in ['reconcile', '--reconcile'])
+    profile = any(profile_flag in sys.argv for profile_flag in ['profile', '--profile'])
+    try:
+        run_pipeline('agg_subreddit_metrics_hourly', pipeline, is_test, full_reconcile, profile=profile)
+    finally:
+        close_pool()
@@ -1,19 +1,38 @@
 import sys
 from datetime import datetime
 
-from common.db_operations import execute_sql, create_partition, get_missing_date_hours
+from common.instrumentation import run_pipeline
+from common.db_operations import (execute_sql, create_partition, get_date_hours_to_process, transaction, close_pool,
+                                  chunk_date_hours, date_hours_values_sql, record_watermarks, WATERMARK_TABLE_NAME,
+                                  shard_date_hours_by_day, run_sharded, get_unprocessed_date_hours, delete_date_hours)
+from common.schema_management import maintain_table
+from common.compact_storage import (is_compact, compact_table_name, compact_partition_prefix, ids_view_name,
+                                    id_keyed_source, migrate_to_compact, drop_legacy_table)
 
 
 # Global constants
 SOURCE_TABLE_NAME_BASE = 'reddit_data'
 TARGET_TABLE_NAME_BASE = 'fct_reddit_snapshots_hourly'
 TARGET_PARTITION_PREFIX_BASE ='frsh_'
+LATEST_TABLE_NAME_BASE = 'fct_reddit_posts_latest'
+PARTITION_RETENTION_DAYS = None  # None keeps every partition; must stay above the agg lookback
 
 SOURCE_DATE_FIELD = 'apicall_date'
-SOURCE_HOUR_FIELD = 'extract(hour from apicall_time)'
+SOURCE_HOUR_FIELD = 'apicall_hour'
 TARGET_DATE_FIELD = 'snapshotted_on'
 TARGET_HOUR_FIELD = 'snapshotted_hour'
 FACT_BACKFILL_LOOKBACK_DAYS = 28
+FACT_TRANSFORM_MODE = 'parallel'  # 'parallel' (one shard per day partition), 'batch' or 'hourly'
+FACT_BATCH_SIZE_HOURS = 168
+FACT_WORKERS = 4
+LATEST_STATE_FIELDS = ('subreddit', 'snapshotted_on', 'snapshotted_hour', 'snapshotted_at', 'upvote_count',
+                       'downvote_count', 'upvote_ratio', 'comment_count', 'award_count', 'post_created_at')
+LATEST_STATE_PREVIOUS_FIELDS = ('snapshotted_on', 'snapshotted_hour', 'upvote_count',
+                                'downvote_count', 'comment_count', 'award_count')
+# Compact storage layout, widest types first so rows need no alignment padding
+COMPACT_INSERT_COLUMNS = ('post_id', 'post_created_at', 'snapshotted_at', 'snapshotted_on', 'upvote_count',
+                          'downvote_count', 'comment_count', 'award_count', 'subreddit_id', 'snapshotted_hour',
+                          'upvote_ratio_permille')
 
 
 def create_table(table_name):
@@ -67,7 +86,7 @@ def transform_reddit_data(source_table_name,
                 total_awards_received as award_count,
                 post_rank,
                 created_at as post_created_at,
-                extract(hour from apicall_time) as snapshotted_hour
+                apicall_hour as snapshotted_hour
             from 
                 {source_table_name}
         )
@@ -96,33 +115,442 @@ def transform_reddit_data(source_table_name,
     execute_sql(sql=transform_sql)
 
 
-def pipeline(is_test):
+def transform_reddit_data_batch(source_table_name,
+                                target_table_name,
+                                date_hours):
+    source_dates = ', '.join(sorted(set(f"'{date_hour[0]}'" for date_hour in date_hours)))
+    transform_sql = f"""
+        insert into {target_table_name}(snapshotted_on,
+                                        snapshotted_hour,
+                                        post_id,
+                                        subreddit,
+                                        upvote_count,
+                                        downvote_count,
+                                        upvote_ratio,
+                                        comment_count,
+                                        award_count,
+                                        post_created_at,
+                                        snapshotted_at)
+
+        with missing_date_hours(snapshotted_on, snapshotted_hour) as (
+            values
+            {date_hours_values_sql(date_hours)}
+        ),
+
+        stg_reddit_data as (
+            select
+                apicall_date as snapshotted_on,
+                apicall_time as snapshotted_at,
+                subreddit,
+                name as post_id,
+                ups as upvote_count,
+                downs as downvote_count,
+                created_utc,
+                upvote_ratio,
+                num_comments as comment_count,
+                total_awards_received as award_count,
+                post_rank,
+                created_at as post_created_at,
+                apicall_hour as snapshotted_hour
+            from 
+                {source_table_name}
+            where
+                apicall_date in ({source_dates})
+        )
+
+        select distinct on (1,2,3)
+            stg.snapshotted_on,
+            stg.snapshotted_hour,
+            stg.post_id,
+            stg.subreddit,
+            stg.upvote_count,
+            stg.downvote_count,
+            stg.upvote_ratio,
+            stg.comment_count,
+            stg.award_count,
+            stg.post_created_at,
+            stg.snapshotted_at
+        from 
+            stg_reddit_data as stg
+            inner join missing_date_hours as mdh
+            on stg.snapshotted_on = mdh.snapshotted_on
+            and stg.snapshotted_hour = mdh.snapshotted_hour
+        order by 
+            1, 2, 3, stg.snapshotted_at desc
+    """
+    execute_sql(sql=transform_sql)
+
+
+def create_compact_table(compact_name):
+    create_sql = f"""
+        CREATE TABLE IF NOT EXISTS {compact_name} (
+            post_id BIGINT,
+            post_created_at TIMESTAMPTZ,
+            snapshotted_at TIME,
+            snapshotted_on DATE,
+            upvote_count INTEGER,
+            downvote_count INTEGER,
+            comment_count INTEGER,
+            award_count INTEGER,
+            subreddit_id SMALLINT,
+            snapshotted_hour SMALLINT,
+            upvote_ratio_permille SMALLINT,
+            PRIMARY KEY (snapshotted_on, snapshotted_hour, post_id))
+        PARTITION BY RANGE (snapshotted_on);
+    """
+    execute_sql(sql=create_sql)
+
+
+def copy_partition_to_compact_sql(partition_name, compact_name):
+    return f"""
+        insert into {compact_name}({', '.join(COMPACT_INSERT_COLUMNS)})
+        select
+            reddit_id_to_bigint(legacy.post_id),
+            legacy.post_created_at::TIMESTAMP at time zone 'UTC',
+            legacy.snapshotted_at,
+            legacy.snapshotted_on,
+            legacy.upvote_count,
+            legacy.downvote_count,
+            legacy.comment_count,
+            legacy.award_count,
+            subreddits.subreddit_id,
+            legacy.snapshotted_hour,
+            round(legacy.upvote_ratio * 1000)
+        from {partition_name} as legacy
+        left join dim_subreddits as subreddits
+        on legacy.subreddit = subreddits.subreddit;
+    """
+
+
+def create_compatibility_views(table_name, compact_name):
+    # The legacy name keeps its columns, order and text formats; the ids view keeps the bigint
+    # post_id and timestamptz for the agg joins and the latest-state table
+    create_sql = f"""
+        CREATE OR REPLACE VIEW {ids_view_name(table_name)} AS
+        select
+            compact.snapshotted_on,
+            compact.snapshotted_hour::INTEGER as snapshotted_hour,
+            compact.post_id,
+            compact.snapshotted_at,
+            subreddits.subreddit,
+            compact.upvote_count,
+            compact.downvote_count,
+            compact.upvote_ratio_permille / 1000::FLOAT as upvote_ratio,
+            compact.comment_count,
+            compact.award_count,
+            compact.post_created_at,
+            compact.subreddit_id
+        from {compact_name} as compact
+        left join dim_subreddits as subreddits
+        on compact.subreddit_id = subreddits.subreddit_id;
+
+        CREATE OR REPLACE VIEW {table_name} AS
+        select
+            snapshotted_on,
+            snapshotted_hour,
+            reddit_id_to_name(post_id) as post_id,
+            snapshotted_at,
+            subreddit,
+            upvote_count,
+            downvote_count,
+            upvote_ratio,
+            comment_count,
+            award_count,
+            to_char(post_created_at at time zone 'UTC', 'YYYY-MM-DD HH24:MI:SS')::VARCHAR as post_created_at
+        from {ids_view_name(table_name)};
+
+        CREATE OR REPLACE FUNCTION {table_name}_insert() RETURNS TRIGGER AS $$
+        BEGIN
+            INSERT INTO {compact_name}({', '.join(COMPACT_INSERT_COLUMNS)})
+            VALUES (reddit_id_to_bigint(NEW.post_id),
+                    NEW.post_created_at::TIMESTAMP at time zone 'UTC',
+                    NEW.snapshotted_at,
+                    NEW.snapshotted_on,
+                    NEW.upvote_count,
+                    NEW.downvote_count,
+                    NEW.comment_count,
+                    NEW.award_count,
+                    subreddit_to_id(NEW.subreddit),
+                    NEW.snapshotted_hour,
+                    round(NEW.upvote_ratio * 1000));
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER {table_name}_insert
+        INSTEAD OF INSERT ON {table_name}
+        FOR EACH ROW EXECUTE FUNCTION {table_name}_insert();
+    """
+    execute_sql(sql=create_sql)
+
+
+def migrate_to_compact_storage(source_table_name, target_table_name, target_partition_prefix, latest_table_name):
+    # The compact transform reads the compact source, so reddit_data has to be migrated first (extract --compact).
+    # The latest-state table switches key type, so it is dropped and rebuilt from fct by its watermarks
+    if is_compact(target_table_name):
+        return
+    if not is_compact(source_table_name):
+        raise RuntimeError(f"Migrate {source_table_name} to compact storage before {target_table_name}")
+    with transaction():
+        migrate_to_compact(target_table_name,
+                           target_partition_prefix,
+                           compact_partition_prefix(target_partition_prefix),
+                           create_compact_table=create_compact_table,
+                           copy_partition_sql=copy_partition_to_compact_sql,
+                           create_compatibility_views=create_compatibility_views)
+        execute_sql(sql=f"DROP TABLE IF EXISTS {latest_table_name};")
+        execute_sql(sql=f"delete from {WATERMARK_TABLE_NAME} where table_name = '{latest_table_name}';")
+        create_latest_table(latest_table_name, compact=True)
+
+
+def transform_reddit_data_batch_compact(source_compact_name,
+                                        target_compact_name,
+                                        date_hours):
+    # Compact to compact: no id decoding or text formatting on the way, just the dedup
+    source_dates = ', '.join(sorted(set(f"'{date_hour[0]}'" for date_hour in date_hours)))
+    transform_sql = f"""
+        insert into {target_compact_name}({', '.join(COMPACT_INSERT_COLUMNS)})
+
+        with missing_date_hours(snapshotted_on, snapshotted_hour) as (
+            values
+            {date_hours_values_sql(date_hours)}
+        )
+
+        select distinct on (stg.apicall_date, stg.apicall_hour, stg.post_id)
+            stg.post_id,
+            stg.created_at as post_created_at,
+            stg.apicall_time as snapshotted_at,
+            stg.apicall_date as snapshotted_on,
+            stg.ups as upvote_count,
+            stg.downs as downvote_count,
+            stg.num_comments as comment_count,
+            stg.total_awards_received as award_count,
+            stg.subreddit_id,
+            stg.apicall_hour as snapshotted_hour,
+            stg.upvote_ratio_permille
+        from
+            {source_compact_name} as stg
+            inner join missing_date_hours as mdh
+            on stg.apicall_date = mdh.snapshotted_on
+            and stg.apicall_hour = mdh.snapshotted_hour
+        where
+            stg.apicall_date in ({source_dates})
+        order by
+            stg.apicall_date, stg.apicall_hour, stg.post_id, stg.apicall_time desc
+    """
+    execute_sql(sql=transform_sql)
+
+
+def transform_date_hours(source_table_name, target_table_name, date_hours, compact=False):
+    # Hours handed back by a late extract load already have rows, which the primary key would reject
+    delete_date_hours(compact_table_name(target_table_name) if compact else target_table_name,
+                      TARGET_DATE_FIELD, TARGET_HOUR_FIELD, date_hours)
+    if compact:
+        transform_reddit_data_batch_compact(source_compact_name=compact_table_name(source_table_name),
+                                            target_compact_name=compact_table_name(target_table_name),
+                                            date_hours=date_hours)
+        return
+    transform_reddit_data_batch(source_table_name=source_table_name,
+                                target_table_name=target_table_name,
+                                date_hours=date_hours)
+
+
+def create_latest_table(latest_table_name, compact=False):
+    # One row per post: its newest snapshot and the one before it, so deltas need no history scan.
+    # Keyed like the fct relation it is merged from: bigint ids once fct is compact
+    post_id_type, post_created_at_type = ('BIGINT', 'TIMESTAMPTZ') if compact else ('VARCHAR', 'VARCHAR')
+    create_sql = f"""
+        CREATE TABLE IF NOT EXISTS {latest_table_name} (
+            post_id {post_id_type} PRIMARY KEY,
+            subreddit VARCHAR,
+            snapshotted_on DATE,
+            snapshotted_hour INTEGER,
+            snapshotted_at TIME,
+            upvote_count INTEGER,
+            downvote_count INTEGER,
+            upvote_ratio FLOAT,
+            comment_count INTEGER,
+            award_count INTEGER,
+            post_created_at {post_created_at_type},
+            prev_snapshotted_on DATE,
+            prev_snapshotted_hour INTEGER,
+            prev_upvote_count INTEGER,
+            prev_downvote_count INTEGER,
+            prev_comment_count INTEGER,
+            prev_award_count INTEGER);
+        CREATE INDEX IF NOT EXISTS {latest_table_name}_date_hour_subreddit_idx
+            ON {latest_table_name} (snapshotted_on, snapshotted_hour, subreddit);
+    """
+    execute_sql(sql=create_sql)
+
+
+def upsert_latest_state(source_table_name, latest_table_name, date_hours, snapshot_rank):
+    # Keeps the two newest snapshots per post whatever order hours arrive in:
+    # newer than current shifts current to prev, between prev and current only replaces prev,
+    # and a rebuilt current or prev hour (e.g. after late rows) overwrites its own slot
+    source_dates = ', '.join(sorted(set(f"'{date_hour[0]}'" for date_hour in date_hours)))
+    incoming_key = '(excluded.snapshotted_on, excluded.snapshotted_hour)'
+    current_key = '(latest.snapshotted_on, latest.snapshotted_hour)'
+    previous_key = '(latest.prev_snapshotted_on, latest.prev_snapshotted_hour)'
+    current_assignments = ',\n            '.join(
+        f"{field} = case when {incoming_key} >= {current_key} then excluded.{field} else latest.{field} end"
+        for field in LATEST_STATE_FIELDS)
+    previous_assignments = ',\n            '.join(
+        f"""prev_{field} = case when {incoming_key} > {current_key} then latest.{field}
+                when {incoming_key} = {current_key} then latest.prev_{field}
+                else excluded.{field} end"""
+        for field in LATEST_STATE_PREVIOUS_FIELDS)
+    upsert_sql = f"""
+        insert into {latest_table_name} as latest(post_id, {', '.join(LATEST_STATE_FIELDS)})
+
+        with merged_date_hours(snapshotted_on, snapshotted_hour) as (
+            values
+            {date_hours_values_sql(date_hours)}
+        ),
+
+        ranked_snapshots as (
+            select
+                fct.*,
+                row_number() over(partition by fct.post_id
+                    order by fct.snapshotted_on desc, fct.snapshotted_hour desc)
+                    as snapshot_rank
+            from
+                {source_table_name} as fct
+                inner join merged_date_hours as mdh
+                on fct.snapshotted_on = mdh.snapshotted_on
+                and fct.snapshotted_hour = mdh.snapshotted_hour
+            where
+                fct.snapshotted_on in ({source_dates})
+        )
+
+        select
+            post_id,
+            {', '.join(LATEST_STATE_FIELDS)}
+        from
+            ranked_snapshots
+        where
+            snapshot_rank = {snapshot_rank}
+        order by
+            post_id
+
+        on conflict (post_id) do update set
+            {current_assignments},
+            {previous_assignments}
+        where
+            {incoming_key} >= {current_key}
+            or latest.prev_snapshotted_on is null
+            or {incoming_key} >= {previous_key}
+    """
+    execute_sql(sql=upsert_sql)
+
+
+def update_latest_state(source_table_name, latest_table_name, date_hours):
+    # A post can't be upserted twice in one statement, so each post's second newest snapshot goes in first
+    source_relation = id_keyed_source(source_table_name)
+    upsert_latest_state(source_relation, latest_table_name, date_hours, snapshot_rank=2)
+    upsert_latest_state(source_relation, latest_table_name, date_hours, snapshot_rank=1)
+
+
+def merge_latest_state(target_table_name, latest_table_name):
+    # Tracked by its own watermarks, so hours committed by a run that died before merging are picked up later
+    pending_date_hours = get_unprocessed_date_hours(source_table_name=target_table_name,
+                                                    target_table_name=latest_table_name,
+                                                    lookback_days=FACT_BACKFILL_LOOKBACK_DAYS)
+    for date_hours in chunk_date_hours(pending_date_hours, FACT_BATCH_SIZE_HOURS):
+        with transaction():
+            update_latest_state(target_table_name, latest_table_name, date_hours)
+            record_watermarks(latest_table_name, date_hours)
+
+
+def transform_day_shard(source_table_name, target_table_name, date_hours, compact=False):
+    transform_date_hours(source_table_name, target_table_name, date_hours, compact=compact)
+    record_watermarks(target_table_name, date_hours)
+
+
+def pipeline(is_test, full_reconcile=False, compact=False, drop_legacy=False):
     source_table_name = SOURCE_TABLE_NAME_BASE if not is_test else 'test_' + SOURCE_TABLE_NAME_BASE
     target_table_name = TARGET_TABLE_NAME_BASE if not is_test else 'test_' + TARGET_TABLE_NAME_BASE
     target_partition_prefix = TARGET_PARTITION_PREFIX_BASE if not is_test else 'test_' + TARGET_PARTITION_PREFIX_BASE
+    latest_table_name = LATEST_TABLE_NAME_BASE if not is_test else 'test_' + LATEST_TABLE_NAME_BASE
+
+    if compact:
+        create_table(target_table_name)
+        migrate_to_compact_storage(source_table_name, target_table_name, target_partition_prefix, latest_table_name)
+    if drop_legacy:
+        drop_legacy_table(target_table_name, target_partition_prefix, TARGET_DATE_FIELD)
+
+    # Watermarks and gap detection stay on the logical names; only DDL and writes go to the physical table
+    compact = is_compact(target_table_name)
+    physical_table_name = compact_table_name(target_table_name) if compact else target_table_name
+    physical_partition_prefix = (compact_partition_prefix(target_partition_prefix) if compact
+                                 else target_partition_prefix)
+    if compact:
+        create_compact_table(physical_table_name)
+    else:
+        create_table(target_table_name)
+    create_latest_table(latest_table_name, compact=compact)
+    maintain_table(physical_table_name, physical_partition_prefix, retention_days=PARTITION_RETENTION_DAYS)
+
+    missing_date_hours = get_date_hours_to_process(source_table_name=source_table_name,
+                                                   source_date_field=SOURCE_DATE_FIELD,
+                                                   source_hour_field=SOURCE_HOUR_FIELD,
+                                                   target_table_name=target_table_name,
+                                                   target_date_field=TARGET_DATE_FIELD,
+                                                   target_hour_field=TARGET_HOUR_FIELD,
+                                                   lookback_days=FACT_BACKFILL_LOOKBACK_DAYS,
+                                                   full_reconcile=full_reconcile)
 
-    create_table(target_table_name)
+    with transaction():
+        for missing_date_partition in set([date_hour[0] for date_hour in missing_date_hours]):
+            create_partition(physical_table_name, physical_partition_prefix, date_stamp=missing_date_partition)
 
-    missing_date_hours = get_missing_date_hours(source_table_name=source_table_name,
-                                                source_date_field=SOURCE_DATE_FIELD,
-                                                source_hour_field=SOURCE_HOUR_FIELD,
-                                                target_table_name=target_table_name, 
-                                                target_date_field=TARGET_DATE_FIELD, 
-                                                target_hour_field=TARGET_HOUR_FIELD, 
-                                                lookback_days=FACT_BACKFILL_LOOKBACK_DAYS)
+    if FACT_TRANSFORM_MODE == 'parallel':
+        # Days are independent: each reads and writes its own partitions and commits its own watermarks
+        shards = [(source_table_name, target_table_name, date_hours, compact)
+                  for date_hours in shard_date_hours_by_day(missing_date_hours).values()]
+        errors = [error for _, error in run_sharded(transform_day_shard, shards, FACT_WORKERS)
+                  if error is not None]
+        # Merged serially after the shards, so concurrent days never contend for the same post rows
+        merge_latest_state(target_table_name, latest_table_name)
+        if errors:
+            raise errors[0]
+        return
 
-    for missing_date_partition in set([date_hour[0] for date_hour in missing_date_hours]):
-        create_partition(target_table_name, target_partition_prefix, date_stamp=missing_date_partition)
+    if FACT_TRANSFORM_MODE == 'batch':
+        for date_hours in chunk_date_hours(missing_date_hours, FACT_BATCH_SIZE_HOURS):
+            with transaction():
+                transform_date_hours(source_table_name, target_table_name, date_hours, compact=compact)
+                record_watermarks(target_table_name, date_hours)
+                update_latest_state(target_table_name, latest_table_name, date_hours)
+                record_watermarks(latest_table_name, date_hours)
+        merge_latest_state(target_table_name, latest_table_name)
+        return
 
     for date_hour in missing_date_hours:
         snapshotted_on = date_hour[0]
         snapshotted_hour = date_hour[1]
-        transform_reddit_data(source_table_name=source_table_name, 
-                              target_table_name=target_table_name,
-                              snapshotted_on=snapshotted_on, 
-                              snapshotted_hour=snapshotted_hour)
+        with transaction():
+            if compact:
+                transform_date_hours(source_table_name, target_table_name, [date_hour], compact=True)
+            else:
+                delete_date_hours(target_table_name, TARGET_DATE_FIELD, TARGET_HOUR_FIELD, [date_hour])
+                transform_reddit_data(source_table_name=source_table_name, 
+                                      target_table_name=target_table_name,
+                                      snapshotted_on=snapshotted_on, 
+                                      snapshotted_hour=snapshotted_hour)
+            record_watermarks(target_table_name, [date_hour])
+            update_latest_state(target_table_name, latest_table_name, [date_hour])
+            record_watermarks(latest_table_name, [date_hour])
+    merge_latest_state(target_table_name, latest_table_name)
 
 
 if __name__ == '__main__':
     is_test = any(test_flag in sys.argv for test_flag in ['test', '--test'])
-    pipeline(is_test)
\ No newline at end of file
+    full_reconcile = any(reconcile_flag in sys.argv for reconcile_flag in ['reconcile', '--reconcile'])
+    compact = any(compact_flag in sys.argv for compact_flag in ['compact', '--compact'])
+    drop_legacy = any(drop_legacy_flag in sys.argv for drop_legacy_flag in ['drop-legacy', '--drop-legacy'])
+    profile = any(profile_flag in sys.argv for profile_flag in ['profile', '--profile'])
+    try:
+        run_pipeline('fct_reddit_snapshots_hourly', pipeline, is_test, full_reconcile, compact, drop_legacy, profile=profile)
+    finally:
+        close_pool()
@@ -0,0 +1,193 @@
+from datetime import timedelta
+
+from common.db_operations import execute_sql, transaction
+from common.schema_management import table_exists
+
+
+# Global constants
+HOURLY_TABLE_SUFFIX = '_hourly'
+ROLLUP_TIERS = ('weekly', 'daily', 'hourly')  # Coarsest first
+METRIC_FIELDS = ('overlapping_posts_between_snapshots', 'upvotes', 'downvotes', 'comments', 'awards')
+
+
+def rollup_table_names(hourly_table_name):
+    table_name_base = hourly_table_name[:-len(HOURLY_TABLE_SUFFIX)]
+    return {'hourly': hourly_table_name,
+            'daily': table_name_base + '_daily',
+            'weekly': table_name_base + '_weekly'}
+
+
+def create_rollup_tables(hourly_table_name):
+    table_names = rollup_table_names(hourly_table_name)
+    create_sql = f"""
+        CREATE TABLE IF NOT EXISTS {table_names['daily']} (
+            subreddit VARCHAR,
+            snapshotted_on DATE,
+            hours_covered INTEGER,
+            overlapping_posts_between_snapshots BIGINT,
+            upvotes BIGINT,
+            downvotes BIGINT,
+            comments BIGINT,
+            awards BIGINT,
+            PRIMARY KEY (subreddit, snapshotted_on));
+
+        CREATE TABLE IF NOT EXISTS {table_names['weekly']} (
+            subreddit VARCHAR,
+            week_start DATE,
+            hours_covered INTEGER,
+            overlapping_posts_between_snapshots BIGINT,
+            upvotes BIGINT,
+            downvotes BIGINT,
+            comments BIGINT,
+            awards BIGINT,
+            PRIMARY KEY (subreddit, week_start));
+    """
+    execute_sql(sql=create_sql)
+
+
+def _sum_metrics_sql():
+    return ',\n'.join(f"sum({metric_field}) as {metric_field}" for metric_field in METRIC_FIELDS)
+
+
+def refresh_daily_rollup(hourly_table_name, snapshot_dates):
+    # Whole days are recomputed from the hourly rows, so late, backfilled or rewritten hours are always reflected
+    daily_table_name = rollup_table_names(hourly_table_name)['daily']
+    date_list_sql = ', '.join(f"'{snapshot_date}'::DATE" for snapshot_date in snapshot_dates)
+    refresh_sql = f"""
+        delete from {daily_table_name}
+        where snapshotted_on in ({date_list_sql});
+
+        insert into {daily_table_name}(subreddit, snapshotted_on, hours_covered, {', '.join(METRIC_FIELDS)})
+        select
+            subreddit,
+            snapshotted_on,
+            count(distinct snapshotted_hour) as hours_covered,
+            {_sum_metrics_sql()}
+        from {hourly_table_name}
+        where snapshotted_on in ({date_list_sql})
+        group by 1, 2;
+    """
+    execute_sql(sql=refresh_sql)
+
+
+def refresh_weekly_rollup(hourly_table_name, snapshot_dates):
+    # Weeks are rebuilt from the (already refreshed) daily rows: at most 7 per subreddit
+    table_names = rollup_table_names(hourly_table_name)
+    week_list_sql = ', '.join(f"date_trunc('week', '{snapshot_date}'::DATE)::DATE" for snapshot_date in snapshot_dates)
+    refresh_sql = f"""
+        delete from {table_names['weekly']}
+        where week_start in ({week_list_sql});
+
+        insert into {table_names['weekly']}(subreddit, week_start, hours_covered, {', '.join(METRIC_FIELDS)})
+        select
+            subreddit,
+            date_trunc('week', snapshotted_on)::DATE as week_start,
+            sum(hours_covered) as hours_covered,
+            {_sum_metrics_sql()}
+        from {table_names['daily']}
+        where snapshotted_on >= least({week_list_sql})
+        and date_trunc('week', snapshotted_on)::DATE in ({week_list_sql})
+        group by 1, 2;
+    """
+    execute_sql(sql=refresh_sql)
+
+
+def update_rollups(hourly_table_name, date_hours):
+    # Called in the same transaction that wrote the hours, so the tiers never disagree
+    snapshot_dates = sorted(set(date_hour[0] for date_hour in date_hours))
+    if not snapshot_dates:
+        return
+    with transaction():
+        refresh_daily_rollup(hourly_table_name, snapshot_dates)
+        refresh_weekly_rollup(hourly_table_name, snapshot_dates)
+
+
+def rebuild_rollups(hourly_table_name):
+    snapshot_dates = [snapshot_date for (snapshot_date,) in execute_sql(
+        sql=f"select distinct snapshotted_on::VARCHAR from {hourly_table_name} order by 1;")]
+    with transaction():
+        create_rollup_tables(hourly_table_name)
+        if snapshot_dates:
+            refresh_daily_rollup(hourly_table_name, snapshot_dates)
+            refresh_weekly_rollup(hourly_table_name, snapshot_dates)
+
+
+def prepare_rollups(hourly_table_name, full_rebuild=False):
+    # A new rollup table starts from the whole hourly history, later runs only touch the hours they write
+    if full_rebuild or not table_exists(rollup_table_names(hourly_table_name)['daily']):
+        rebuild_rollups(hourly_table_name)
+
+
+def _floor_day(moment):
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _ceil_day(moment):
+    day = _floor_day(moment)
+    return day if day == moment else day + timedelta(days=1)
+
+
+def split_range_by_tier(start, end):
+    # start inclusive, end exclusive -> [(tier, start, end)]: hourly head and tail, daily edges and a weekly
+    # middle, so a long range reads a few rollup rows per week instead of every hour
+    day_start, day_end = _ceil_day(start), _floor_day(end)
+    if day_start >= day_end:
+        return [('hourly', start, end)] if start < end else []
+
+    week_start = day_start + timedelta(days=(7 - day_start.weekday()) % 7)
+    week_end = day_end - timedelta(days=day_end.weekday())
+    if week_start < week_end:
+        segments = [('hourly', start, day_start),
+                    ('daily', day_start, week_start),
+                    ('weekly', week_start, week_end),
+                    ('daily', week_end, day_end),
+                    ('hourly', day_end, end)]
+    else:
+        segments = [('hourly', start, day_start),
+                    ('daily', day_start, day_end),
+                    ('hourly', day_end, end)]
+    return [(tier, segment_start, segment_end)
+            for tier, segment_start, segment_end in segments
+            if segment_start < segment_end]
+
+
+def _read_tier_sql(table_name, tier, subreddit, start, end):
+    if tier == 'hourly':
+        return f"""
+            select
+                snapshotted_on + make_interval(hours => snapshotted_hour) as period_start,
+                1 as hours_covered,
+                {', '.join(METRIC_FIELDS)}
+            from {table_name}
+            where subreddit = '{subreddit}'
+            and snapshotted_on between '{start.date()}' and '{end.date()}'
+            and snapshotted_on + make_interval(hours => snapshotted_hour) >= '{start}'::TIMESTAMP
+            and snapshotted_on + make_interval(hours => snapshotted_hour) < '{end}'::TIMESTAMP
+        """
+    period_field = 'week_start' if tier == 'weekly' else 'snapshotted_on'
+    return f"""
+            select
+                {period_field}::TIMESTAMP as period_start,
+                hours_covered,
+                {', '.join(METRIC_FIELDS)}
+            from {table_name}
+            where subreddit = '{subreddit}'
+            and {period_field} >= '{start.date()}'
+            and {period_field} < '{end.date()}'
+        """
+
+
+def read_subreddit_metrics(hourly_table_name, subreddit, start, end, tier=None):
+    # Returns (period start, hours covered, *METRIC_FIELDS) rows over [start, end), each part of the range
+    # read from the coarsest tier aligned with it; a given tier reads the whole range from that tier
+    if tier is not None and tier not in ROLLUP_TIERS:
+        raise ValueError(f"Unknown rollup tier '{tier}', expected one of {ROLLUP_TIERS}")
+    segments = [(tier, start, end)] if tier is not None else split_range_by_tier(start, end)
+    if not segments:
+        return []
+
+    table_names = rollup_table_names(hourly_table_name)
+    read_sql = '\n            union all\n'.join(
+        _read_tier_sql(table_names[segment_tier], segment_tier, subreddit, segment_start, segment_end)
+        for segment_tier, segment_start, segment_end in segments)
+    return execute_sql(sql=read_sql + '\n            order by 1;')